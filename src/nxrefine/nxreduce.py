@@ -8,13 +8,14 @@
 
 import logging
 import logging.handlers
-import operator
 import os
 import platform
 import shutil
 import subprocess
+import time
 import timeit
 from datetime import datetime
+from functools import partial
 
 import h5py as h5
 import numpy as np
@@ -33,7 +34,12 @@ from .nxrefine import NXRefine
 from .nxserver import NXServer
 from .nxsettings import NXSettings
 from .nxsymmetry import NXSymmetry
-from .nxutils import init_julia, load_julia, mask_volume, peak_search
+from .nxutils import (NXExecutor, NXFrameBuffer, NXGapMap, NXMaskWriter,
+                      NXPrefetcher, as_completed, binned_search,
+                      get_calibration, init_julia, init_worker, label_search,
+                      load_julia, mask_slab, maximum_slab, merge_peaks,
+                      peak_search, plan_slabs, read_frames, reduce_slab,
+                      run_slabs)
 
 
 class NXReduce(QtCore.QObject):
@@ -60,6 +66,12 @@ class NXReduce(QtCore.QObject):
         min_pixels : int, optional
             Minimum number of pixels required in Bragg peak searches, by
             default 10
+        engine : str, optional
+            Engine used in Bragg peak searches, either 'maxima', which
+            links the local maxima of each frame, 'label', which labels
+            3D connected regions above the threshold, or 'binned', which
+            only labels regions selected from binned data, by default
+            'maxima'
         first : int, optional
             First frame included in the data reduction, by default None
         last : int, optional
@@ -116,6 +128,12 @@ class NXReduce(QtCore.QObject):
             Use mask in performing transforms, by default False
         overwrite : bool, optional
             Overwrite previous analyses, by default False
+        live : bool, optional
+            Find peaks while the raw data are still being written, by
+            default False
+        fused : bool, optional
+            Read the raw data once for the maximum counts, peak search
+            and 3D mask, by default False
         monitor_progress : bool, optional
             Monitor progress at the command line, by default False
         gui : bool, optional
@@ -124,16 +142,16 @@ class NXReduce(QtCore.QObject):
 
     def __init__(
             self, entry=None, directory=None, parent=None, entries=None,
-            threshold=None, min_pixels=None, first=None, last=None,
-            polar_max=None, hkl_tolerance=None, monitor=None, norm=None,
-            polarization=None, qmin=None, qmax=None,
+            threshold=None, min_pixels=None, engine=None, first=None,
+            last=None, polar_max=None, hkl_tolerance=None, monitor=None,
+            norm=None, polarization=None, qmin=None, qmax=None,
             radius=None, mask_parameters=None,
             Qh=None, Qk=None, Ql=None,
             load=False, link=False, copy=False,
             maxcount=False, find=False, refine=False, prepare=False,
             transform=False, combine=False, pdf=False,
             lattice=False, regular=False, mask=False, overwrite=False,
-            monitor_progress=False, gui=False):
+            live=False, fused=False, monitor_progress=False, gui=False):
 
         super(NXReduce, self).__init__()
 
@@ -183,6 +201,9 @@ class NXReduce(QtCore.QObject):
         self._field = None
         self._shape = None
         self._pixel_mask = None
+        self._gap_map = None
+        self._hot_pixels = None
+        self._scan_hot_pixels = None
         self._parent = parent
         self._parent_root = None
         self._parent_entry = None
@@ -191,6 +212,7 @@ class NXReduce(QtCore.QObject):
 
         self._threshold = threshold
         self._min_pixels = min_pixels
+        self._engine = engine
         self._first = first
         self._last = last
         self._polar_max = polar_max
@@ -230,6 +252,8 @@ class NXReduce(QtCore.QObject):
         if not self.mask:
             self.regular = True
         self.overwrite = overwrite
+        self.live = live
+        self.fused = fused
         self.monitor_progress = monitor_progress
         self.gui = gui
         self.timer = {}
@@ -237,6 +261,8 @@ class NXReduce(QtCore.QObject):
         self.summed_frames = None
         self.partial_frames = None
         self.summed_data = None
+        self._reduced = {}
+        self._fused_tasks = []
 
         self._stopped = False
         self._process_count = None
@@ -249,6 +275,9 @@ class NXReduce(QtCore.QObject):
 
         nxsetconfig(lock=3600, lockexpiry=28800)
 
+    hot_pixel_fraction = 0.5
+    """Fraction of the registered scans in which a pixel must be hot."""
+
     start = QtCore.Signal(object)
     update = QtCore.Signal(object)
     result = QtCore.Signal(object)
@@ -462,6 +491,113 @@ class NXReduce(QtCore.QObject):
     @pixel_mask.setter
     def pixel_mask(self, value):
         self._pixel_mask = value
+        self._gap_map = None
+
+    @property
+    def gap_map(self):
+        """Gaps in the detector defined by the masked and hot pixels."""
+        if self._gap_map is None:
+            self._gap_map = NXGapMap(self.hot_pixel_mask())
+        return self._gap_map
+
+    @property
+    def hot_pixel_file(self):
+        """File containing the hot pixels registered for each detector."""
+        return os.path.join(self.task_directory, 'hot_pixels.nxs')
+
+    @property
+    def hot_pixel_group(self):
+        """Name of the hot pixel registry group for the current detector."""
+        return f"detector_{self.shape[1]}x{self.shape[2]}"
+
+    @property
+    def hot_pixels(self):
+        """Hot pixels registered by previous scans with the same detector.
+
+        A pixel is included if it was found to be hot in at least a
+        fraction, `hot_pixel_fraction`, of the registered scans, so
+        pixels that stop firing are eventually unmasked.
+        """
+        if self._hot_pixels is None:
+            try:
+                counts, scans = self.read_hot_pixel_registry()
+                self._hot_pixels = self.registered_hot_pixels(counts, scans)
+            except Exception as error:
+                self.logger.info(
+                    f"Unable to read hot pixel registry: {error}")
+                self._hot_pixels = np.zeros((self.shape[1], self.shape[2]),
+                                            dtype=np.int8)
+        return self._hot_pixels
+
+    def registered_hot_pixels(self, counts, scans):
+        """Return the hot pixels defined by the registry counts.
+
+        Parameters
+        ----------
+        counts : ndarray
+            Number of scans in which each pixel was found to be hot.
+        scans : int
+            Number of registered scans.
+
+        Returns
+        -------
+        ndarray
+            2D mask of the hot pixels.
+        """
+        return ((counts > 0) &
+                (counts >= self.hot_pixel_fraction * scans)).astype(np.int8)
+
+    def read_hot_pixel_registry(self):
+        """Return the hot pixel counts and number of registered scans.
+
+        Returns
+        -------
+        tuple
+            Number of scans in which each pixel was found to be hot, and
+            the number of registered scans, which are zero if no scans
+            have been registered with the current detector.
+        """
+        counts = np.zeros((self.shape[1], self.shape[2]), dtype=np.int32)
+        scans = 0
+        if os.path.exists(self.hot_pixel_file):
+            with NXLock(self.hot_pixel_file):
+                with h5.File(self.hot_pixel_file, 'r') as f:
+                    if self.hot_pixel_group in f:
+                        counts = f[self.hot_pixel_group]['counts'][()]
+                        scans = int(f[self.hot_pixel_group]['scans'][()])
+        return counts, scans
+
+    def register_hot_pixels(self, hot_pixels):
+        """Add the hot pixels found in a scan to the detector registry.
+
+        The registry records the number of scans in which each pixel was
+        found to be constantly firing, and the number of scans that have
+        been registered. The file lock is held for the whole update, so
+        that entries reduced concurrently do not overwrite each other's
+        counts.
+
+        Parameters
+        ----------
+        hot_pixels : ndarray
+            2D boolean array of the hot pixels found in the scan.
+        """
+        hot_pixels = np.asarray(hot_pixels, dtype=bool)
+        with NXLock(self.hot_pixel_file):
+            with h5.File(self.hot_pixel_file, 'a') as f:
+                if self.hot_pixel_group not in f:
+                    group = f.create_group(self.hot_pixel_group)
+                    group.attrs['NX_class'] = 'NXcollection'
+                    group.create_dataset(
+                        'counts', data=np.zeros(hot_pixels.shape,
+                                                dtype=np.int32))
+                    group.create_dataset('scans', data=0)
+                group = f[self.hot_pixel_group]
+                group['counts'][...] = group['counts'][()] + hot_pixels
+                group['scans'][()] = group['scans'][()] + 1
+        self._hot_pixels = None
+        self._gap_map = None
+        self.logger.info(f"{hot_pixels.sum()} hot pixels registered in "
+                         f"'{self.hot_pixel_file}'")
 
     @property
     def parent(self):
@@ -694,6 +830,36 @@ class NXReduce(QtCore.QObject):
     def min_pixels(self, value):
         self._min_pixels = int(value)
 
+    @property
+    def peak_halo(self):
+        """Number of frames added to each side of the peak search slabs.
+
+        A halo of `min_pixels` is not enough. Peaks are kept by the slab
+        containing their refined z-value, but the box of half-width
+        `min_pixels` used to refine a peak is centered on its maximum
+        frame, which can lie several frames further from the centroid,
+        and the connected regions used by the 'label' and 'binned'
+        engines extend more than `min_pixels` frames beyond the centroid
+        of broad peaks. If the slab ends inside the box or region, the
+        peak is truncated, and its position and intensity depend on
+        where the slab boundaries lie. A halo of twice `min_pixels`
+        covers both.
+        """
+        return 2 * self.min_pixels
+
+    @property
+    def engine(self):
+        """Engine used to search for Bragg peaks."""
+        if self._engine is None:
+            self._engine = 'maxima'
+        return self._engine
+
+    @engine.setter
+    def engine(self, value):
+        if value not in ['maxima', 'label', 'binned']:
+            raise NeXusError(f"Invalid peak search engine '{value}'")
+        self._engine = value
+
     @property
     def monitor(self):
         """Name of the field to be used to correct for the incident flux."""
@@ -874,6 +1040,144 @@ class NXReduce(QtCore.QObject):
                 self._process_count = 4
         return self._process_count
 
+    def slabs(self, halo=0, stop=None, bytes_per_pixel=16, chunks=None):
+        """Return the slabs of raw data to be processed as separate tasks.
+
+        The slabs are aligned with the HDF5 chunks of the raw data and
+        sized according to the number of processes and the available
+        memory, including the memory of the `frame_buffer` shared by
+        concurrent tasks. The choice of slab size is logged.
+
+        Parameters
+        ----------
+        halo : int, optional
+            Number of frames added to each side of a slab, by default 0
+        stop : int, optional
+            Upper limit of the frames read in any slab, by default None
+        bytes_per_pixel : int, optional
+            Memory required to process each pixel, by default 16
+        chunks : tuple of ints, optional
+            Chunk shape of the raw data, by default the chunk shape of
+            the raw data field
+
+        Returns
+        -------
+        list of tuples
+            List of (i, j, k) values defining the first output frame and
+            the limits of the frames read in each slab.
+        """
+        buffer_bytes_per_pixel = 0
+        if self.server.concurrent:
+            processes = workers = self.process_count
+            if not self.live:
+                # Concurrent slabs are loaded into the `frame_buffer`
+                buffer_bytes_per_pixel = np.dtype(self.field.dtype).itemsize
+        else:
+            # Serial slabs are read in advance by `prefetch`, so two slabs
+            # are held in memory
+            processes, workers = 1, 2
+        if chunks is None:
+            chunks = self.field.chunks
+        slabs = plan_slabs(self.first, self.last, self.shape, chunks=chunks,
+                           halo=halo, stop=stop, workers=workers,
+                           bytes_per_pixel=bytes_per_pixel,
+                           buffer_bytes_per_pixel=buffer_bytes_per_pixel)
+        size = max(np.diff([s[0] for s in slabs] + [self.last+1]))
+        self.logger.info(
+            f"{len(slabs)} slabs of {size} frames with a halo of {halo} "
+            f"(chunks: {chunks}, processes: {processes})")
+        return slabs
+
+    def frame_buffer(self, slabs):
+        """Return a shared buffer for the frames of concurrent slabs.
+
+        The buffer holds enough frames for one more slab than the number
+        of processes, so that the next slab can be loaded while the
+        others are being processed.
+
+        Parameters
+        ----------
+        slabs : list of tuples
+            List of (i, j, k) values returned by `slabs`.
+
+        Returns
+        -------
+        NXFrameBuffer
+            Ring buffer of raw data frames in shared memory.
+        """
+        size = min((self.process_count + 1) * max(k-j for _, j, k in slabs),
+                   slabs[-1][2] - slabs[0][1])
+        return NXFrameBuffer(size, self.shape[1:], self.field.dtype)
+
+    def prefetch(self, slabs):
+        """Yield each slab, while the next slab is read in the background.
+
+        This is used when the slabs are processed serially. The time
+        spent reading the raw data, and the time spent waiting for the
+        reads to complete, are logged at the end.
+
+        Parameters
+        ----------
+        slabs : list of tuples
+            List of (i, j, k) values returned by `slabs`.
+
+        Yields
+        ------
+        tuple
+            Values of (i, j, k) of each slab, followed by its frames.
+        """
+        reader = NXPrefetcher(self.field.nxfilename, self.field.nxfilepath,
+                              slabs)
+        yield from reader
+        self.logger.info(f"Raw data read in {reader.read_time:g} seconds "
+                         f"({reader.wait_time:g} seconds waiting)")
+
+    def open_live_data(self, timeout=600):
+        """Open the raw data file for reading while it is being written.
+
+        The file is opened in HDF5 single-writer/multiple-reader (SWMR)
+        mode, after waiting for it to be created if necessary.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            Time in seconds to wait for the file, by default 600
+
+        Returns
+        -------
+        h5py.File
+            Raw data file opened in SWMR mode.
+        """
+        tic = timeit.default_timer()
+        while not self.raw_data_exists():
+            if timeit.default_timer() - tic > timeout:
+                raise NeXusError(f"Timed out waiting for '{self.raw_file}'")
+            time.sleep(1)
+        return h5.File(self.raw_file, 'r', libver='latest', swmr=True)
+
+    def wait_for_frames(self, dataset, k, timeout=600):
+        """Wait until the first k frames have been written to the dataset.
+
+        Parameters
+        ----------
+        dataset : h5py.Dataset
+            Raw data opened in SWMR mode.
+        k : int
+            Number of frames required.
+        timeout : float, optional
+            Time in seconds to wait for each new frame, by default 600
+        """
+        tic = timeit.default_timer()
+        nframes = dataset.shape[0]
+        while nframes < k:
+            time.sleep(1)
+            dataset.refresh()
+            if dataset.shape[0] > nframes:
+                nframes = dataset.shape[0]
+                tic = timeit.default_timer()
+            elif timeit.default_timer() - tic > timeout:
+                raise NeXusError(f"Timed out waiting for frame {k}")
+
     def record(self, task, **kwargs):
         """Record the completion of a task in the current entry.
 
@@ -1071,7 +1375,8 @@ class NXReduce(QtCore.QObject):
             if not self.raw_data_exists():
                 self.logger.info("Data file not available")
                 return
-            self.record_start('nxmax')
+            if 'nxmax' not in self._fused_tasks:
+                self.record_start('nxmax')
             try:
                 result = self.find_maximum()
                 if self.gui:
@@ -1093,62 +1398,144 @@ class NXReduce(QtCore.QObject):
             self.logger.info("Maximum counts already found")
 
     def find_maximum(self):
+        if 'nxmax' in self._reduced:
+            return self._reduced.pop('nxmax')
         self.logger.info("Finding maximum counts")
-        with self.field.nxfile:
-            maximum = 0.0
-            chunk_size = self.field.chunks[0]
-            if chunk_size < 20:
-                chunk_size = 50
-            data = self.field.nxfile[self.raw_path]
-            fsum = np.zeros(self.nframes, dtype=np.float64)
-            psum = np.zeros(self.nframes, dtype=np.float64)
-            pixel_mask = self.pixel_mask
-            # Add constantly firing pixels to the mask
-            pixel_max = np.zeros((self.shape[1], self.shape[2]))
-            v = data[0:10, :, :]
-            for i in range(10):
-                pixel_max = np.maximum(v[i, :, :], pixel_max)
-            pixel_mean = v.sum(0) / 10.
-            mask = np.zeros((self.shape[1], self.shape[2]), dtype=np.int8)
-            mask[np.where(pixel_max == pixel_mean)] = 1
-            mask[np.where(pixel_mean < 100)] = 0
-            pixel_mask = pixel_mask | mask
-            transmission_mask = self.transmission_coordinates()
-            # Start looping over the data
-            tic = self.start_progress(self.first, self.last)
-            for i in range(self.first, self.last, chunk_size):
+        pixel_mask = self.hot_pixel_mask()
+        task = self.maximum_task(pixel_mask)
+        vsum = vmin = vmax = None
+        fsum = np.zeros(self.nframes, dtype=np.float64)
+        psum = np.zeros(self.nframes, dtype=np.float64)
+        tic = self.start_progress(self.first, self.last)
+
+        def add_slab(i, result):
+            nonlocal vsum, vmin, vmax
+            slab_sum, slab_fsum, slab_psum, slab_min, slab_max = result
+            if vsum is None:
+                vsum, vmin, vmax = slab_sum, slab_min, slab_max
+            else:
+                vsum = vsum + slab_sum
+                vmin = np.minimum(vmin, slab_min)
+                vmax = np.maximum(vmax, slab_max)
+            fsum[i:i+len(slab_fsum)] = slab_fsum
+            psum[i:i+len(slab_psum)] = slab_psum
+            self.update_progress(i)
+
+        slabs = self.slabs()
+        if self.server.concurrent:
+            with self.frame_buffer(slabs) as buffer:
+                with NXExecutor(max_workers=self.process_count,
+                                initializer=init_worker,
+                                initargs=(self.field.nxfilename,
+                                          buffer.spec)) as executor:
+                    for i, result in run_slabs(
+                            executor, task, slabs, buffer,
+                            self.field.nxfilename, self.field.nxfilepath):
+                        if self.stopped:
+                            return None
+                        add_slab(i, result)
+        else:
+            for i, j, k, frames in self.prefetch(slabs):
                 if self.stopped:
                     return None
-                self.update_progress(i)
-                try:
-                    v = data[i:i+chunk_size, :, :]
-                except IndexError:
-                    pass
-                if i == self.first:
-                    vsum = v.sum(0)
-                else:
-                    vsum += v.sum(0)
-                v = np.ma.masked_array(v)
-                v.mask = pixel_mask
-                fsum[i:i+chunk_size] = v.sum((1, 2))
-                v.mask = pixel_mask | transmission_mask
-                psum[i:i+chunk_size] = v.sum((1, 2))
-                if maximum < v.max():
-                    maximum = v.max()
-                del v
-        self.pixel_mask = pixel_mask
+                add_slab(*task(i, j, k, slab=(j, frames)))
+        toc = self.stop_progress()
+        result = self.store_maximum(vsum, fsum, psum, vmin, vmax, pixel_mask)
+        self.logger.info(
+            f"Maximum counts: {self.maximum} ({(toc-tic):g} seconds)")
+        return result
+
+    def maximum_task(self, pixel_mask):
+        """Return the task that finds the maximum counts of each slab.
+
+        Parameters
+        ----------
+        pixel_mask : ndarray
+            Pixel mask including the constantly firing pixels.
+        """
+        frame_weights = pixel_mask == 0
+        partial_weights = frame_weights & ~self.transmission_coordinates()
+        return partial(maximum_slab, self.field.nxfilename,
+                       self.field.nxfilepath, frame_weights=frame_weights,
+                       partial_weights=partial_weights)
+
+    def updated_hot_pixels(self, hot_pixels):
+        """Return the registered hot pixels after adding those of a scan.
+
+        Parameters
+        ----------
+        hot_pixels : ndarray
+            2D boolean array of the hot pixels found in the scan.
+
+        Returns
+        -------
+        ndarray
+            Hot pixels that would be masked once the scan is registered
+            by `register_hot_pixels`.
+        """
+        counts, scans = self.read_hot_pixel_registry()
+        return self.registered_hot_pixels(counts + hot_pixels, scans + 1)
+
+    def hot_pixel_mask(self):
+        """Return the pixel mask with the registered hot pixels added.
+
+        The hot pixels are those found to be constantly firing in
+        previous scans with the same detector, so no frames need to be
+        read.
+        """
+        return self.pixel_mask | self.hot_pixels
+
+    def store_maximum(self, vsum, fsum, psum, vmin, vmax, pixel_mask):
+        """Store the results of the search for the maximum counts.
+
+        Pixels that are constant throughout the scan, with mean counts
+        of at least 100, are added to the pixel mask as hot pixels. The
+        frame sums are corrected for any that were not already masked.
+        The hot pixels registered by previous scans are not added to the
+        stored pixel mask, but are applied with it by `hot_pixel_mask`.
+
+        Parameters
+        ----------
+        vsum : ndarray
+            Sum of all the frames.
+        fsum : ndarray
+            Sum of each frame outside the pixel mask.
+        psum : ndarray
+            Sum of each frame outside the pixel and transmission masks.
+        vmin : ndarray
+            Minimum counts of each pixel.
+        vmax : ndarray
+            Maximum counts of each pixel.
+        pixel_mask : ndarray
+            Pixel mask used in calculating the frame sums, including the
+            registered hot pixels.
+
+        Returns
+        -------
+        NXcollection
+            Collection containing the stored results.
+        """
+        start, stop = self.first, min(self.last+1, self.nframes)
+        hot_pixels = (vmax == vmin) & (vsum >= 100 * (stop - start))
+        new_pixels = hot_pixels & (pixel_mask == 0)
+        transmission = self.transmission_coordinates()
+        fsum[start:stop] -= vmax[new_pixels].sum()
+        psum[start:stop] -= vmax[new_pixels & ~transmission].sum()
+        pixel_mask = pixel_mask | hot_pixels
+        maximum = vmax[(pixel_mask == 0) & ~transmission].max(initial=0)
+        if new_pixels.any():
+            self.logger.info(f"{new_pixels.sum()} new hot pixels found")
+        self._scan_hot_pixels = hot_pixels
+        self.pixel_mask = self.pixel_mask | hot_pixels
         vsum = np.ma.masked_array(vsum)
         vsum.mask = pixel_mask
         self.maximum = maximum
         self.summed_data = NXfield(vsum, name='summed_data')
         self.summed_frames = NXfield(fsum, name='summed_frames')
         self.partial_frames = NXfield(psum, name='partial_frames')
-        toc = self.stop_progress()
-        self.logger.info(f"Maximum counts: {maximum} ({(toc-tic):g} seconds)")
-        result = NXcollection(NXfield(maximum, name='maximum'),
-                              self.summed_data, self.summed_frames,
-                              self.partial_frames)
-        return result
+        return NXcollection(NXfield(maximum, name='maximum'),
+                            self.summed_data, self.summed_frames,
+                            self.partial_frames)
 
     def write_maximum(self):
         with self:
@@ -1156,6 +1543,9 @@ class NXReduce(QtCore.QObject):
             self.entry['data'].attrs['first'] = self.first
             self.entry['data'].attrs['last'] = self.last
             self.entry['instrument/detector/pixel_mask'] = self.pixel_mask
+            if self._scan_hot_pixels is not None:
+                self.register_hot_pixels(self._scan_hot_pixels)
+                self._scan_hot_pixels = None
             if 'summed_data' in self.entry:
                 del self.entry['summed_data']
             self.entry['summed_data'] = NXdata(self.summed_data,
@@ -1170,25 +1560,17 @@ class NXReduce(QtCore.QObject):
 
     def calculate_radial_sums(self):
         try:
-            from pyFAI.azimuthalIntegrator import AzimuthalIntegrator
-            parameters = (
-                self.entry['instrument/calibration/refinement/parameters'])
-            ai = AzimuthalIntegrator(
-                dist=parameters['Distance'].nxvalue,
-                detector=parameters['Detector'].nxvalue,
-                poni1=parameters['Poni1'].nxvalue,
-                poni2=parameters['Poni2'].nxvalue,
-                rot1=parameters['Rot1'].nxvalue,
-                rot2=parameters['Rot2'].nxvalue,
-                rot3=parameters['Rot3'].nxvalue,
-                pixel1=parameters['PixelSize1'].nxvalue,
-                pixel2=parameters['PixelSize2'].nxvalue,
-                wavelength=parameters['Wavelength'].nxvalue)
-            polarization = ai.polarization(factor=self.polarization)
+            calibration = get_calibration(
+                self.entry['instrument/calibration/refinement/parameters'],
+                cache_file=os.path.join(self.task_directory,
+                                        'calibrations.nxs'),
+                logger=self.logger)
+            ai = calibration.integrator
+            polarization = calibration.polarization(self.polarization)
             counts = (self.summed_data.nxvalue.filled(fill_value=0)
                       / polarization)
             polar_angle, intensity = ai.integrate1d(
-                counts, 2048, unit='2th_deg', mask=self.pixel_mask,
+                counts, 2048, unit='2th_deg', mask=self.hot_pixel_mask(),
                 correctSolidAngle=True, method=('no', 'histogram', 'cython'))
             Q = (4 * np.pi * np.sin(np.radians(polar_angle) / 2.0)
                  / (ai.wavelength * 1e10))
@@ -1228,7 +1610,34 @@ class NXReduce(QtCore.QObject):
                 transmission *= correction
             return transmission
 
-    def calculate_transmission(self, frame_window=5, filter_size=20):
+    def calculate_transmission(self, frame_window=5, filter_size=20,
+                               settings=None):
+        """Estimate the sample transmission from the partial frame sums.
+
+        The minimum of the normalized partial frame sums is taken in
+        windows spaced through the scan. These minima are smoothed by a
+        median filter and interpolated over all the frames.
+
+        Parameters
+        ----------
+        frame_window : int, optional
+            Half-width of the windows used to find the minima, by default
+            5
+        filter_size : int, optional
+            Size of the median filter applied to the minima, by default
+            20
+        settings : list of tuples, optional
+            Pairs of frame windows and filter sizes to be compared in a
+            single call, by default None, in which case only the given
+            frame window and filter size are used.
+
+        Returns
+        -------
+        NXdata or dict of NXdata
+            Estimated sample transmission, or, if a list of settings is
+            given, a dictionary of such groups, with the settings as
+            keys.
+        """
         if self.partial_frames is None:
             if ('summed_frames' in self.entry
                     and 'partial_frames' in self.entry['summed_frames']):
@@ -1239,35 +1648,43 @@ class NXReduce(QtCore.QObject):
             y = self.partial_frames.nxvalue
 
         from scipy.interpolate import interp1d
-        from scipy.ndimage.filters import median_filter
+        from scipy.ndimage import median_filter, minimum_filter1d
 
         y = y / self.read_monitor()
         x = np.arange(self.nframes)
-        dx = frame_window
-        ms = filter_size
-        xmin = x[self.first+dx:self.last-dx:2*dx]
-        ymin = median_filter(np.array([min(y[i-dx:i+dx]) for i in xmin]),
-                             size=ms)
-        yabs = np.ones(shape=x.shape, dtype=np.float32)
-        yabs[xmin[0]:xmin[-1]] = interp1d(
-            xmin, ymin, kind='cubic')(x[xmin[0]:xmin[-1]])
-        yabs[0:xmin[0]] = yabs[xmin[0]]
-        yabs[xmin[-1]:] = yabs[xmin[-1]-1]
-        xout = list(x[::100])
-        yout = list(yabs[::100])
-        if max(xout) < x.max():
-            xout = xout + [x[-1]]
-            yout = yout + [yabs[-1]]
-        yabs = interp1d(xout, yout, kind='cubic')(x)
-        transmission = NXfield(yabs / yabs.max(), name='transmission',
-                               long_name='Sample Transmission')
-        transmission.attrs['maximum'] = yabs.max()
-        frames = NXfield(np.arange(self.nframes), name='nframes',
-                         long_title='Frame No.')
-        group = NXdata(transmission, frames, title='Sample Transmission')
-        group.attrs['frame_window'] = frame_window
-        group.attrs['filter_size'] = filter_size
-        return group
+        minima = {}
+
+        def transmission(dx, ms):
+            if dx not in minima:
+                xmin = x[self.first+dx:self.last-dx:2*dx]
+                minima[dx] = xmin, minimum_filter1d(y, 2*dx)[xmin]
+            xmin, ymin = minima[dx]
+            ymin = median_filter(ymin, size=ms)
+            yabs = np.ones(shape=x.shape, dtype=np.float32)
+            yabs[xmin[0]:xmin[-1]] = interp1d(
+                xmin, ymin, kind='cubic')(x[xmin[0]:xmin[-1]])
+            yabs[0:xmin[0]] = yabs[xmin[0]]
+            yabs[xmin[-1]:] = yabs[xmin[-1]-1]
+            xout = list(x[::100])
+            yout = list(yabs[::100])
+            if max(xout) < x.max():
+                xout = xout + [x[-1]]
+                yout = yout + [yabs[-1]]
+            yabs = interp1d(xout, yout, kind='cubic')(x)
+            transmission = NXfield(yabs / yabs.max(), name='transmission',
+                                   long_name='Sample Transmission')
+            transmission.attrs['maximum'] = yabs.max()
+            frames = NXfield(np.arange(self.nframes), name='nframes',
+                             long_title='Frame No.')
+            group = NXdata(transmission, frames, title='Sample Transmission')
+            group.attrs['frame_window'] = dx
+            group.attrs['filter_size'] = ms
+            return group
+
+        if settings is None:
+            return transmission(frame_window, filter_size)
+        else:
+            return {(dx, ms): transmission(dx, ms) for dx, ms in settings}
 
     def transmission_coordinates(self):
         refine = NXRefine(self.entry)
@@ -1298,21 +1715,23 @@ class NXReduce(QtCore.QObject):
 
     def nxfind(self):
         if self.not_processed('nxfind') and self.find:
-            if not self.raw_data_exists():
+            if not self.raw_data_exists() and not self.live:
                 self.logger.info("Data file not available")
                 return
-            self.record_start('nxfind')
+            if 'nxfind' not in self._fused_tasks:
+                self.record_start('nxfind')
             try:
                 peaks = self.find_peaks()
                 if self.gui:
-                    if peaks:
+                    if peaks is not None:
                         self.result.emit(peaks)
                     self.stop.emit()
-                elif peaks:
+                elif len(peaks) > 0:
                     self.write_peaks(peaks)
                     self.write_parameters(threshold=self.threshold,
                                           first=self.first, last=self.last)
                     self.record('nxfind', threshold=self.threshold,
+                                engine=self.engine,
                                 first=self.first, last=self.last,
                                 peak_number=len(peaks))
                     self.record_end('nxfind')
@@ -1325,53 +1744,164 @@ class NXReduce(QtCore.QObject):
         elif self.find:
             self.logger.info("Peaks already found")
 
-    def find_peaks(self):
-        self.logger.info("Finding peaks")
+    def find_peaks(self, thresholds=None):
+        """Find the Bragg peaks in the raw data.
+
+        Parameters
+        ----------
+        thresholds : list of floats, optional
+            Thresholds to be compared in a single pass through the data,
+            by default None, in which case the current threshold is used.
+
+        Returns
+        -------
+        ndarray or dict of ndarrays
+            Structured array of dtype `peak_dtype` containing the peaks,
+            or, if a list of thresholds is given, a dictionary of such
+            arrays, with the thresholds as keys.
+        """
+        if thresholds is None and 'nxfind' in self._reduced:
+            return self._reduced.pop('nxfind')
+        self.logger.info(f"Finding peaks using the '{self.engine}' engine")
+        if thresholds is None:
+            threshold = self.threshold
+        else:
+            threshold = [float(t) for t in thresholds]
+        search = self.peak_search_function()
         tic = self.start_progress(self.first, self.last)
-        self.blobs = []
-        if self.server.concurrent:
-            from nxrefine.nxutils import NXExecutor, as_completed
-            from multiprocessing import get_context
-            with NXExecutor(max_workers=self.process_count) as executor:
+        halo = self.peak_halo
+        if self.live:
+            raw_file = self.open_live_data()
+            dataset = raw_file[self.raw_path]
+            self._shape = (self.nframes,) + dataset.shape[1:]
+            slabs = self.slabs(halo=halo,
+                               stop=min(self.last+halo, self.nframes),
+                               chunks=dataset.chunks)
+        else:
+            slabs = self.slabs(halo=halo,
+                               stop=min(self.last+halo, self.nframes))
+        starts = [i for i, _, _ in slabs]
+        ends = dict(zip(starts, starts[1:] + [self.last]))
+        results = []
+        if self.live:
+            task = partial(search, self.raw_file, self.raw_path,
+                           threshold=threshold, min_pixels=self.min_pixels,
+                           pixel_mask=self.hot_pixels)
+            if self.server.concurrent:
+                workers = self.process_count
+            else:
+                workers = 1
+            with raw_file, NXExecutor(max_workers=workers,
+                                      initializer=init_worker,
+                                      initargs=(self.raw_file, None,
+                                                True)) as executor:
                 futures = []
-                for i in range(self.first, self.last+1, 50):
-                    j, k = i - min(5, i), min(i+55, self.last+5, self.nframes)
-                    futures.append(executor.submit(
-                        peak_search,
-                        self.field.nxfilename, self.field.nxfilepath,
-                        i, j, k, self.threshold, min_pixels=self.min_pixels))
+                for i, j, k in slabs:
+                    self.wait_for_frames(dataset, k)
+                    futures.append(executor.submit(task, i, j, k))
+                    self.logger.info(f"Searching frames {i} to {ends[i]}")
                 for future in as_completed(futures):
-                    z, blobs = future.result()
-                    self.blobs += [b for b in blobs if b.z >= z
-                                   and b.z < min(z+50, self.last)]
+                    z, peaks = future.result()
+                    results.append((z, peaks))
                     self.update_progress(z)
-                    futures.remove(future)
+        elif self.server.concurrent:
+            task = partial(search, self.field.nxfilename,
+                           self.field.nxfilepath, threshold=threshold,
+                           min_pixels=self.min_pixels,
+                           pixel_mask=self.hot_pixels)
+            with self.frame_buffer(slabs) as buffer:
+                with NXExecutor(max_workers=self.process_count,
+                                initializer=init_worker,
+                                initargs=(self.field.nxfilename,
+                                          buffer.spec)) as executor:
+                    for z, peaks in run_slabs(
+                            executor, task, slabs, buffer,
+                            self.field.nxfilename, self.field.nxfilepath):
+                        results.append((z, peaks))
+                        self.update_progress(z)
         else:
-            for i in range(self.first, self.last+1, 50):
-                j, k = i - min(5, i), min(i+55, self.last+5, self.nframes)
-                z, blobs = peak_search(
+            for i, j, k, frames in self.prefetch(slabs):
+                z, peaks = search(
                     self.field.nxfilename, self.field.nxfilepath,
-                    i, j, k, self.threshold, min_pixels=self.min_pixels)
-                self.blobs += [b for b in blobs if b.z >= z
-                               and b.z < min(z+50, self.last)]
+                    i, j, k, threshold, min_pixels=self.min_pixels,
+                    pixel_mask=self.hot_pixels, slab=(j, frames))
+                results.append((z, peaks))
                 self.update_progress(z)
 
-        peaks = sorted([b for b in self.blobs], key=operator.attrgetter('z'))
-
         toc = self.stop_progress()
-        self.logger.info(f"{len(peaks)} peaks found ({toc - tic:g} seconds)")
+        if thresholds is None:
+            peaks = merge_peaks(results, ends)
+            self.logger.info(
+                f"{len(peaks)} peaks found ({toc - tic:g} seconds)")
+        else:
+            peaks = {t: merge_peaks([(z, p[n]) for z, p in results], ends)
+                     for n, t in enumerate(threshold)}
+            for t in peaks:
+                self.logger.info(
+                    f"{len(peaks[t])} peaks found with threshold {t:g}")
+            self.logger.info(f"Threshold sweep completed ({toc - tic:g} "
+                             "seconds)")
+        if self.engine == 'binned' and not self.live:
+            self.log_speedup(slabs, threshold, toc - tic)
         return peaks
 
+    def log_speedup(self, slabs, threshold, elapsed):
+        """Log the speedup of the binned search over a full search.
+
+        The middle slab is searched again, both by `binned_search` and
+        by `label_search`, which searches the whole slab at full
+        resolution. The ratio of their times is used to estimate the
+        time that a full-resolution search of every slab would have
+        taken.
+
+        Parameters
+        ----------
+        slabs : list of tuples
+            List of (i, j, k) values of the slabs that were searched.
+        threshold : float or list of floats
+            Peak threshold or thresholds used in the search.
+        elapsed : float
+            Time in seconds taken by the binned search.
+        """
+        i, j, k = slabs[len(slabs) // 2]
+        slab = (j, read_frames(self.field.nxfilename, self.field.nxfilepath,
+                               j, k))
+        times = []
+        for search in [binned_search, label_search]:
+            tic = timeit.default_timer()
+            search(self.field.nxfilename, self.field.nxfilepath, i, j, k,
+                   threshold, min_pixels=self.min_pixels,
+                   pixel_mask=self.hot_pixels, slab=slab)
+            times.append(timeit.default_timer() - tic)
+        speedup = times[1] / times[0]
+        self.logger.info(
+            f"Binned search: {elapsed:g} seconds; estimated full-resolution "
+            f"search: {elapsed * speedup:g} seconds (speedup {speedup:.1f}x, "
+            f"measured on frames {j} to {k})")
+
+    def peak_search_function(self):
+        """Return the function used to search slabs for peaks.
+
+        The function depends on the current peak search engine.
+        """
+        if self.engine == 'label':
+            return label_search
+        elif self.engine == 'binned':
+            return binned_search
+        else:
+            return peak_search
+
     def write_peaks(self, peaks):
+        """Write the peak table to the 'peaks' group of the current entry.
+
+        Parameters
+        ----------
+        peaks : ndarray
+            Structured array of dtype `peak_dtype` returned by `find_peaks`.
+        """
         group = NXreflections()
-        group['intensity'] = NXfield([peak.intensity for peak in peaks],
-                                     dtype=float)
-        group['x'] = NXfield([peak.x for peak in peaks], dtype=float)
-        group['y'] = NXfield([peak.y for peak in peaks], dtype=float)
-        group['z'] = NXfield([peak.z for peak in peaks], dtype=float)
-        group['sigx'] = NXfield([peak.sigx for peak in peaks], dtype=float)
-        group['sigy'] = NXfield([peak.sigy for peak in peaks], dtype=float)
-        group['sigz'] = NXfield([peak.sigz for peak in peaks], dtype=float)
+        for name in ['intensity', 'x', 'y', 'z', 'sigx', 'sigy', 'sigz']:
+            group[name] = NXfield(peaks[name], dtype=float)
         group.attrs['first'] = self.first
         group.attrs['last'] = self.last
         group.attrs['threshold'] = self.threshold
@@ -1438,7 +1968,8 @@ class NXReduce(QtCore.QObject):
     def nxprepare(self):
         if self.not_processed('nxprepare_mask') and self.prepare:
             try:
-                self.record_start('nxprepare')
+                if 'nxprepare' not in self._fused_tasks:
+                    self.record_start('nxprepare')
                 self.logger.info("Preparing 3D mask")
                 self.mask_file = os.path.join(self.directory,
                                               self.entry_name+'_mask.nxs')
@@ -1470,51 +2001,71 @@ class NXReduce(QtCore.QObject):
 
     def prepare_mask(self):
         """Prepare 3D mask"""
+        if 'nxprepare' in self._reduced:
+            return self._reduced.pop('nxprepare')
         tic = self.start_progress(self.first, self.last)
-        t1 = self.mask_parameters['threshold_1']
-        h1 = self.mask_parameters['horizontal_size_1']
-        t2 = self.mask_parameters['threshold_2']
-        h2 = self.mask_parameters['horizontal_size_2']
+        mask = self.create_mask()
+        slabs = self.slabs(halo=1, stop=min(self.last+1, self.nframes),
+                           bytes_per_pixel=8)
+        frames = {i: (j+1, k-1) for i, j, k in slabs}
+        writer = NXMaskWriter(mask, slabs[0][1]+1)
 
-        mask_root = nxopen(self.mask_file+'.h5', 'w')
-        mask_root['entry'] = NXentry()
-        mask_root['entry/mask'] = (
-            NXfield(shape=self.shape, dtype=np.int8, fillvalue=0))
+        def add_mask(i, packed):
+            writer.add_packed(*frames[i], packed)
+            self.update_progress(i)
 
+        task = self.mask_task()
         if self.server.concurrent:
-            from nxrefine.nxutils import NXExecutor, as_completed
-            with NXExecutor(max_workers=self.process_count) as executor:
-                futures = []
-                for i in range(self.first, self.last+1, 10):
-                    j, k = i - min(1, i), min(i+11, self.last+1, self.nframes)
-                    futures.append(executor.submit(
-                        mask_volume,
-                        self.field.nxfilename, self.field.nxfilepath,
-                        mask_root.nxfilename, 'entry/mask', i, j, k,
-                        self.pixel_mask, t1, h1, t2, h2))
-                for future in as_completed(futures):
-                    k = future.result()
-                    self.update_progress(k)
-                    futures.remove(future)
+            with self.frame_buffer(slabs) as buffer:
+                with NXExecutor(max_workers=self.process_count,
+                                initializer=init_worker,
+                                initargs=(self.field.nxfilename,
+                                          buffer.spec)) as executor:
+                    for i, packed in run_slabs(
+                            executor, task, slabs, buffer,
+                            self.field.nxfilename, self.field.nxfilepath):
+                        add_mask(i, packed)
         else:
-            for i in range(self.first, self.last+1, 10):
-                j, k = i - min(1, i), min(i+11, self.last+1, self.nframes)
-                k = mask_volume(self.field.nxfilename, self.field.nxfilepath,
-                                mask_root.nxfilename, 'entry/mask', i, j, k,
-                                self.pixel_mask, t1, h1, t2, h2)
-                self.update_progress(k)
-
-        frame_mask = np.ones(shape=self.shape[1:], dtype=np.int8)
-        with mask_root.nxfile:
-            mask_root['entry/mask'][:self.first] = frame_mask
-            mask_root['entry/mask'][self.last+1:] = frame_mask
+            for i, j, k, frames in self.prefetch(slabs):
+                add_mask(*task(i, j, k, slab=(j, frames)))
+        writer.write()
+        self.complete_mask(mask)
 
         toc = self.stop_progress()
 
         self.logger.info(f"3D Mask prepared in {toc-tic:g} seconds")
 
+        return mask
+
+    def create_mask(self):
+        """Create the file containing a new 3D mask and return the mask."""
+        mask_root = nxopen(self.mask_file+'.h5', 'w')
+        mask_root['entry'] = NXentry()
+        # The scale-offset filter stores the 0/1 values with a single bit
+        # per pixel before compression. It is a standard HDF5 filter, so
+        # the field is still read as int8 by CCTW and the plotting tools.
+        mask_root['entry/mask'] = (
+            NXfield(shape=self.shape, dtype=np.int8, fillvalue=0,
+                    chunks=(1,)+tuple(self.shape[1:]), compression='gzip',
+                    scaleoffset=0))
         return mask_root['entry/mask']
 
+    def mask_task(self):
+        """Return the task that calculates the 3D mask of each slab."""
+        return partial(mask_slab, self.field.nxfilename,
+                       self.field.nxfilepath, gap_map=self.gap_map,
+                       threshold_1=self.mask_parameters['threshold_1'],
+                       horiz_size_1=self.mask_parameters['horizontal_size_1'],
+                       threshold_2=self.mask_parameters['threshold_2'],
+                       horiz_size_2=self.mask_parameters['horizontal_size_2'])
+
+    def complete_mask(self, mask):
+        """Mask all the frames outside the range used in the reduction."""
+        frame_mask = np.ones(shape=self.shape[1:], dtype=np.int8)
+        with mask.nxfile:
+            mask[:self.first] = frame_mask
+            mask[self.last+1:] = frame_mask
+
     def write_mask(self, mask):
         """Write mask to file."""
         if os.path.exists(self.mask_file):
@@ -1722,12 +2273,14 @@ class NXReduce(QtCore.QObject):
                 new_file = h5.File(self.raw_file, 'r+')
                 new_field = new_file[self.raw_path]
             else:
-                scan_file = h5.File(reduce.raw_file, 'r')
-                scan_field = scan_file[reduce.raw_path]
-                for i in range(0, nframes, chunk_size):
-                    new_slab = new_field[i:i+chunk_size, :, :]
-                    scan_slab = scan_field[i:i+chunk_size, :, :]
-                    new_field[i:i+chunk_size, :, :] = new_slab + scan_slab
+                slabs = [(j, j, min(j+chunk_size, nframes))
+                         for j in range(0, nframes, chunk_size)]
+                reader = NXPrefetcher(reduce.raw_file, reduce.raw_path, slabs)
+                for _, j, k, scan_slab in reader:
+                    new_field[j:k, :, :] = new_field[j:k, :, :] + scan_slab
+                self.logger.info(
+                    f"Raw data read in {reader.read_time:g} seconds "
+                    f"({reader.wait_time:g} seconds waiting)")
         self.logger.info("Raw data files summed")
 
     def sum_monitors(self, scan_list, update=False):
@@ -1757,6 +2310,158 @@ class NXReduce(QtCore.QObject):
             self.entry['monitor2/MCS2'] = monitor2
             self.entry['data/monitor_weight'] = monitor_weight
 
+    def fused_reduction(self):
+        """Read the raw data once for the maximum, peak and mask tasks.
+
+        Each slab of raw data is read once and passed in turn to the
+        calculation of the maximum counts and summed frames, the peak
+        search and the 3D mask, for each of these tasks that is required.
+        The results are stored, so that `nxmax`, `nxfind` and `nxprepare`
+        can write and record them without reading the raw data again.
+        Nothing is done unless at least two of the tasks are required.
+
+        All the tasks are recorded as started before the raw data are
+        read. If the hot pixels found by `nxmax` change the masks used in
+        the peak search or the 3D mask, those results are discarded, so
+        that `nxfind` and `nxprepare` repeat them with the same masks as
+        when the tasks are run separately.
+        """
+        tasks = []
+        if self.maxcount and self.not_processed('nxmax'):
+            tasks.append('nxmax')
+        if self.find and self.not_processed('nxfind'):
+            tasks.append('nxfind')
+        if self.prepare and self.not_processed('nxprepare_mask'):
+            tasks.append('nxprepare')
+        if len(tasks) < 2 or self.live or not self.raw_data_exists():
+            return
+        for task in tasks:
+            self.record_start(task)
+        self._fused_tasks = tasks
+        try:
+            self._reduced = self.reduce_raw_data(tasks)
+        except Exception as error:
+            self.logger.info(str(error))
+            for task in tasks:
+                self.record_fail(task)
+            raise
+
+    def reduce_raw_data(self, tasks):
+        """Perform the tasks in a single pass through the raw data.
+
+        Parameters
+        ----------
+        tasks : list of str
+            Names of the tasks, 'nxmax', 'nxfind' or 'nxprepare'.
+
+        Returns
+        -------
+        dict
+            Results of each task, with the task names as keys.
+        """
+        self.logger.info(f"Reading raw data once for {', '.join(tasks)}")
+        tic = self.start_progress(self.first, self.last)
+        if 'nxfind' in tasks:
+            halo = self.peak_halo
+        else:
+            halo = 1
+        slabs = self.slabs(halo=halo, stop=min(self.last+halo, self.nframes))
+        starts = [i for i, _, _ in slabs]
+        ends = dict(zip(starts, starts[1:] + [self.last+1]))
+        data_file, data_path = self.field.nxfilename, self.field.nxfilepath
+
+        reducers = []
+        if 'nxmax' in tasks:
+            pixel_mask = self.hot_pixel_mask()
+            vsum = vmin = vmax = None
+            fsum = np.zeros(self.nframes, dtype=np.float64)
+            psum = np.zeros(self.nframes, dtype=np.float64)
+            reducers.append(
+                (self.maximum_task(pixel_mask),
+                 {i: (i, min(ends[i], self.nframes)) for i in starts}))
+        if 'nxfind' in tasks:
+            peaks = []
+            search_mask = self.hot_pixels
+            reducers.append(
+                (partial(self.peak_search_function(), data_file, data_path,
+                         threshold=self.threshold,
+                         min_pixels=self.min_pixels,
+                         pixel_mask=search_mask),
+                 {i: (j, k) for i, j, k in slabs}))
+        if 'nxprepare' in tasks:
+            self.mask_file = os.path.join(self.directory,
+                                          self.entry_name+'_mask.nxs')
+            mask = self.create_mask()
+            gap_mask = self.hot_pixel_mask()
+            stop = min(self.last+1, self.nframes)
+            frames = {i: (max(i-1, 0), min(ends[i]+1, stop)) for i in starts}
+            writer = NXMaskWriter(mask, frames[starts[0]][0]+1)
+            reducers.append((self.mask_task(), frames))
+
+        def add_results(i, outputs):
+            nonlocal vsum, vmin, vmax
+            outputs = dict(zip(tasks, outputs))
+            if 'nxmax' in outputs:
+                (slab_sum, slab_fsum, slab_psum,
+                 slab_min, slab_max) = outputs['nxmax']
+                if vsum is None:
+                    vsum, vmin, vmax = slab_sum, slab_min, slab_max
+                else:
+                    vsum = vsum + slab_sum
+                    vmin = np.minimum(vmin, slab_min)
+                    vmax = np.maximum(vmax, slab_max)
+                fsum[i:i+len(slab_fsum)] = slab_fsum
+                psum[i:i+len(slab_psum)] = slab_psum
+            if 'nxfind' in outputs:
+                peaks.append((i, outputs['nxfind']))
+            if 'nxprepare' in outputs:
+                start, stop = frames[i]
+                writer.add_packed(start+1, stop-1, outputs['nxprepare'])
+            self.update_progress(i)
+
+        task = partial(reduce_slab, data_file, data_path, reducers=reducers)
+        if self.server.concurrent:
+            with self.frame_buffer(slabs) as buffer:
+                with NXExecutor(max_workers=self.process_count,
+                                initializer=init_worker,
+                                initargs=(data_file, buffer.spec)) as executor:
+                    for i, outputs in run_slabs(executor, task, slabs,
+                                                buffer, data_file, data_path):
+                        add_results(i, outputs)
+        else:
+            for i, j, k, frames in self.prefetch(slabs):
+                add_results(*task(i, j, k, slab=(j, frames)))
+        toc = self.stop_progress()
+        self.logger.info(f"Raw data reduced in {toc-tic:g} seconds")
+
+        results = {}
+        if 'nxmax' in tasks:
+            results['nxmax'] = self.store_maximum(vsum, fsum, psum, vmin,
+                                                  vmax, pixel_mask)
+            self.logger.info(f"Maximum counts: {self.maximum}")
+        if 'nxfind' in tasks:
+            ends[starts[-1]] = self.last
+            results['nxfind'] = merge_peaks(peaks, ends)
+            self.logger.info(f"{len(results['nxfind'])} peaks found")
+        if 'nxprepare' in tasks:
+            writer.write()
+            self.complete_mask(mask)
+            results['nxprepare'] = mask
+        if 'nxmax' in tasks:
+            hot_pixels = self.updated_hot_pixels(self._scan_hot_pixels)
+            if ('nxfind' in results and
+                    not np.array_equal(hot_pixels, search_mask)):
+                self.logger.info(
+                    "Hot pixels changed: peaks will be searched again")
+                del results['nxfind']
+            if ('nxprepare' in results and
+                    not np.array_equal(self.pixel_mask | hot_pixels,
+                                       gap_mask)):
+                self.logger.info(
+                    "Hot pixels changed: 3D mask will be prepared again")
+                del results['nxprepare']
+        return results
+
     def nxreduce(self):
         if self.load:
             self.nxload()
@@ -1764,6 +2469,8 @@ class NXReduce(QtCore.QObject):
             self.nxlink()
         if self.copy:
             self.nxcopy()
+        if self.fused:
+            self.fused_reduction()
         if self.maxcount:
             self.nxmax()
         if self.find:
@@ -1861,6 +2568,8 @@ class NXReduce(QtCore.QObject):
                 tasks.append('mask')
         if self.overwrite:
             tasks.append('overwrite')
+        if self.fused:
+            tasks.append('fused')
 
         def switches(args):
             d = vars(args)
@@ -7,15 +7,15 @@
 # -----------------------------------------------------------------------------
 
 import os
+from functools import lru_cache
 
 import numpy as np
 from nexusformat.nexus import (NeXusError, NXdata, NXdetector, NXentry,
                                NXfield, NXgoniometer, NXgroup, NXinstrument,
                                NXlink, NXmonochromator, NXroot, NXsample)
 from numpy.linalg import inv, norm
-from scipy import optimize
 
-from .nxutils import init_julia, load_julia
+from .nxutils import get_calibration
 
 degrees = 180.0 / np.pi
 radians = np.pi / 180.0
@@ -56,6 +56,60 @@ def rotmat(axis, angle):
     return np.matrix(mat)
 
 
+def rotmats(axis, angles):
+    """Return a stack of rotation matrices about the specified axis.
+
+    Parameters
+    ----------
+    axis : {1, 2, 3}
+        Index of the rotation axis.
+    angles : array_like
+        Angles of rotation in degrees.
+
+    Returns
+    -------
+    ndarray
+        Array of shape (N, 3, 3) containing a rotation matrix for each
+        angle.
+    """
+    angles = np.ravel(angles) * radians
+    cang, sang = np.cos(angles), np.sin(angles)
+    i, j = [k for k in range(3) if k != axis - 1]
+    mats = np.zeros((angles.size, 3, 3))
+    mats[:, axis-1, axis-1] = 1.0
+    mats[:, i, i] = mats[:, j, j] = cang
+    if axis == 2:
+        mats[:, i, j], mats[:, j, i] = sang, -sang
+    else:
+        mats[:, i, j], mats[:, j, i] = -sang, sang
+    return mats
+
+
+def rotmat_derivative(axis, angle):
+    """Return the derivative of a rotation matrix with respect to its angle.
+
+    Parameters
+    ----------
+    axis : {1, 2, 3}
+        Index of the rotation axis.
+    angle : float
+        Angle of rotation in degrees.
+
+    Returns
+    -------
+    ndarray
+        The 3x3 derivative of `rotmat` per degree.
+    """
+    angle = 0.0 if angle is None else angle * radians
+    cang, sang = np.cos(angle) * radians, np.sin(angle) * radians
+    if axis == 1:
+        return np.array(((0, 0, 0), (0, -sang, -cang), (0, cang, -sang)))
+    elif axis == 2:
+        return np.array(((-sang, 0, cang), (0, 0, 0), (-cang, 0, -sang)))
+    else:
+        return np.array(((-sang, -cang, 0), (cang, -sang, 0), (0, 0, 0)))
+
+
 def vec(x, y=0.0, z=0.0):
     """Return a 1x3 column vector."""
     return np.matrix((x, y, z)).T
@@ -209,12 +263,13 @@ class NXRefine:
 
         self.name = ""
         self._idx = None
+        self._peak_terms_cache = None
+        self._matrix_cache = {}
         self._mode = None
         self._Dmat_cache = inv(rotmat(1, self.roll) * rotmat(2, self.pitch) *
                                rotmat(3, self.yaw))
         self._Gmat_cache = (rotmat(2, self.theta) * rotmat(3, self.omega) *
                             rotmat(1, self.chi))
-        self.julia = None
 
         self.parameters = None
 
@@ -1264,31 +1319,76 @@ class NXRefine:
         except Exception:
             return 0
 
+    def _cached_matrix(self, name, dependencies, function):
+        """Return a cached matrix, recalculating it if its inputs change.
+
+        Parameters
+        ----------
+        name : str
+            Name of the cached matrix.
+        dependencies : tuple
+            Current values of the parameters that define the matrix.
+        function : callable
+            Function that calculates the matrix.
+
+        Returns
+        -------
+        np.matrix
+            Read-only matrix, shared between calls until one of the
+            dependencies changes.
+        """
+        cached = self._matrix_cache.get(name)
+        if cached is not None and cached[0] == dependencies:
+            return cached[1]
+        matrix = function()
+        matrix.flags.writeable = False
+        self._matrix_cache[name] = (dependencies, matrix)
+        return matrix
+
+    @property
+    def _UB_dependencies(self):
+        """Parameters that define the UB matrix."""
+        if self.Umat is None:
+            return self.lattice_parameters, None
+        else:
+            return (self.lattice_parameters,
+                    np.asarray(self.Umat, dtype=np.float64).tobytes())
+
     @property
     def UBmat(self):
         """Return the UB matrix."""
         if self.Umat is not None:
-            return self.Umat * self.Bmat
+            return self._cached_matrix('UBmat', self._UB_dependencies,
+                                       lambda: self.Umat * self.Bmat)
         else:
             return np.matrix(np.eye(3))
 
+    @property
+    def UBimat(self):
+        """Return the inverse UB matrix."""
+        return self._cached_matrix('UBimat', self._UB_dependencies,
+                                   lambda: inv(self.UBmat))
+
     @property
     def Bimat(self):
         """Return the inverse B matrix defined by the unit cell."""
-        a, b, c, alpha, beta, gamma = self.lattice_parameters
-        alpha = alpha * radians
-        beta = beta * radians
-        gamma = gamma * radians
-        B23 = c*(np.cos(alpha)-np.cos(beta)*np.cos(gamma))/np.sin(gamma)
-        B33 = np.sqrt(c**2-(c*np.cos(beta))**2-B23**2)
-        return np.matrix(((a, b*np.cos(gamma), c*np.cos(beta)),
-                         (0, b*np.sin(gamma),  B23),
-                         (0, 0, B33)))
+        def Bimat():
+            a, b, c, alpha, beta, gamma = self.lattice_parameters
+            alpha = alpha * radians
+            beta = beta * radians
+            gamma = gamma * radians
+            B23 = c*(np.cos(alpha)-np.cos(beta)*np.cos(gamma))/np.sin(gamma)
+            B33 = np.sqrt(c**2-(c*np.cos(beta))**2-B23**2)
+            return np.matrix(((a, b*np.cos(gamma), c*np.cos(beta)),
+                             (0, b*np.sin(gamma),  B23),
+                             (0, 0, B33)))
+        return self._cached_matrix('Bimat', self.lattice_parameters, Bimat)
 
     @property
     def Bmat(self):
         """Return the B matrix defined by the unit cell."""
-        return inv(self.Bimat)
+        return self._cached_matrix('Bmat', self.lattice_parameters,
+                                   lambda: inv(self.Bimat))
 
     @property
     def Omat(self):
@@ -1300,20 +1400,28 @@ class NXRefine:
             +X(det) = -y(lab), +Y(det) = -z(lab), and +Z(det) = x(lab)
 
         """
-        _omat = np.zeros((3, 3), dtype=int)
-        i = 0
-        d = 1
-        for c in self.detector_orientation.replace(' ', ''):
-            if c == '+':
-                d = 1
-            elif c == '-':
-                d = -1
-            else:
-                j = 'xyz'.index(c)
-                _omat[i][j] = d
-                d = 1
-                i += 1
-        return np.matrix(_omat)
+        def Omat():
+            _omat = np.zeros((3, 3), dtype=int)
+            i = 0
+            d = 1
+            for c in self.detector_orientation.replace(' ', ''):
+                if c == '+':
+                    d = 1
+                elif c == '-':
+                    d = -1
+                else:
+                    j = 'xyz'.index(c)
+                    _omat[i][j] = d
+                    d = 1
+                    i += 1
+            return np.matrix(_omat)
+        return self._cached_matrix('Omat', self.detector_orientation, Omat)
+
+    @property
+    def Oimat(self):
+        """Return the matrix that rotates lab axes into detector axes."""
+        return self._cached_matrix('Oimat', self.detector_orientation,
+                                   lambda: inv(self.Omat))
 
     @property
     def Dmat(self):
@@ -1324,6 +1432,12 @@ class NXRefine:
         """
         return self._Dmat_cache
 
+    @property
+    def Dimat(self):
+        """Return the inverse detector orientation matrix."""
+        return self._cached_matrix('Dimat', self.tilts,
+                                   lambda: inv(self.Dmat))
+
     def Gmat(self, phi):
         """Return the matrix that physically orients the goniometer head.
 
@@ -1350,32 +1464,112 @@ class NXRefine:
         return vec(self.xs, self.ys, self.zs)
 
     def Gvec(self, x, y, z):
-        phi = self.phi + self.phi_step * z
-        v1 = vec(x, y)
-        v2 = self.pixel_size * inv(self.Omat) * (v1 - self.Cvec)
-        v3 = inv(self.Dmat) * v2 - self.Dvec(phi)
-        return (inv(self.Gmat(phi)) *
-                ((norm_vec(v3) / self.wavelength) - self.Evec))
+        return vec(*self.calculate_Gvecs(x, y, z)[0])
 
     def get_Gvecs(self, idx):
         self.Gvecs = [self.Gvec(x, y, z) for x, y, z
                       in zip(self.xp[idx], self.yp[idx], self.zp[idx])]
         return self.Gvecs
 
+    def calculate_Gvecs(self, x, y, z):
+        """Return the scattering vectors of the specified pixels.
+
+        This is the vectorized form of `Gvec`, with the rotations of each
+        frame applied as a stack of matrices.
+
+        Parameters
+        ----------
+        x, y, z : array_like
+            Pixel coordinates
+
+        Returns
+        -------
+        ndarray
+            Array of shape (N, 3) containing the scattering vectors in
+            the goniometer head coordinates.
+        """
+        return self._scattering_terms(x, y, z, self._geometry())['G']
+
+    @staticmethod
+    def _scattering_terms(x, y, z, g):
+        """Return the scattering vectors and their intermediate values.
+
+        Parameters
+        ----------
+        x, y, z : array_like
+            Pixel coordinates
+        g : dict
+            Geometry returned by `_geometry`.
+
+        Returns
+        -------
+        dict
+            Scattering vectors, 'G', and the values used to calculate
+            them, which are needed for their derivatives.
+        """
+        x, y, z = (np.ravel(v).astype(np.float64) for v in (x, y, z))
+        R = rotmats(3, g['phi'] + g['phi_step'] * z)
+        pixels = np.stack((x - g['xc'], y - g['yc'], np.zeros_like(x)),
+                          axis=-1)
+        v3 = (pixels @ g['Mat'].T - (R @ g['Svec']) @ g['Gmat'].T
+              + (g['distance'], 0.0, 0.0))
+        u = ((v3 / norm(v3, axis=1)[:, np.newaxis] - (1.0, 0.0, 0.0))
+             / g['wavelength'])
+        GTu = u @ g['Gmat']
+        G = np.einsum('nji,nj->ni', R, GTu)
+        return {'z': z, 'pixels': pixels, 'R': R, 'v3': v3, 'u': u,
+                'GTu': GTu, 'G': G}
+
+    def _peak_terms(self, g):
+        """Return the scattering terms of the peaks in `idx`.
+
+        The terms are reused until the peaks or the geometry, other than
+        the lattice parameters and orientation matrix, are changed.
+        """
+        key = tuple(g[k] if np.isscalar(g[k]) else g[k].tobytes()
+                    for k in ('xc', 'yc', 'phi', 'phi_step', 'distance',
+                              'wavelength', 'Mat', 'Gmat', 'Svec'))
+        sources = (self.xp, self.yp, self.zp, self.idx)
+        cache = self._peak_terms_cache
+        if (cache is None or cache[0] != key
+                or any(a is not b for a, b in zip(cache[1], sources))):
+            idx = np.asarray(self.idx, dtype=int)
+            terms = self._scattering_terms(self.xp[idx], self.yp[idx],
+                                           self.zp[idx], g)
+            self._peak_terms_cache = cache = (key, sources, terms)
+        return cache[2]
+
+    def calculate_hkls(self, x, y, z):
+        """Return the HKL indices of the specified pixels.
+
+        Parameters
+        ----------
+        x, y, z : array_like
+            Pixel coordinates
+
+        Returns
+        -------
+        ndarray
+            Array of shape (N, 3) containing the HKL indices.
+        """
+        if self.Umat is not None:
+            return (self.calculate_Gvecs(x, y, z)
+                    @ np.asarray(self.UBimat).T)
+        else:
+            return np.zeros((np.size(x), 3))
+
     def calculate_angles(self, x, y):
         """Return the polar and azimuthal angles of the specified pixels."""
-        Oimat = inv(self.Omat)
-        Mat = self.pixel_size * inv(self.Dmat) * Oimat
-        polar_angles = []
-        azimuthal_angles = []
-        for i in range(len(x)):
-            peak = Oimat * (vec(x[i], y[i]) - self.Cvec)
-            v = norm(Mat * peak)
-            polar_angle = np.arctan(v / self.distance)
-            polar_angles.append(polar_angle)
-            azimuthal_angles.append(np.arctan2(-peak[1, 0], peak[2, 0]))
-        return (np.array(polar_angles) * degrees,
-                np.array(azimuthal_angles) * degrees)
+        x, y = np.ravel(x).astype(np.float64), np.ravel(y).astype(np.float64)
+        Oimat = np.asarray(self.Oimat)
+        Mat = self.pixel_size * np.asarray(self.Dimat) @ Oimat
+        pixels = np.stack((x - self.xc, y - self.yc, np.zeros_like(x)),
+                          axis=-1)
+        peaks = pixels @ Oimat.T
+        v = norm(peaks @ Mat.T, axis=1)
+        polar_angles = np.arctan(v / self.distance)
+        azimuthal_angles = np.arctan2(-peaks[:, 1], peaks[:, 2])
+        return polar_angles * degrees, azimuthal_angles * degrees
 
     def angle_peaks(self, i, j):
         """Return the angle between two peaks in degrees.
@@ -1468,24 +1662,20 @@ class NXRefine:
         list
             HKL indices
         """
-        if self.Umat is not None:
-            v5 = self.Gvec(x, y, z)
-#           v6 = inv(self.Umat) * v5
-#           v7 = inv(self.Bmat) * v6
-            v7 = inv(self.UBmat) * v5
-            return list(np.array(v7.T)[0])
-        else:
-            return [0.0, 0.0, 0.0]
+        return self.calculate_hkls(x, y, z)[0].tolist()
 
     def get_hkls(self):
         """Return the set of hkls for all the  Bragg peaks as three columns."""
-        return zip(*[self.hkl(i) for i in range(self.npks)])
+        if self.npks == 0:
+            return zip()
+        return tuple(self.calculate_hkls(self.xp, self.yp, self.zp).T)
 
     @property
     def hkls(self):
         """The set of HKLs for all the Bragg peaks."""
-        return [self.get_hkl(self.xp[i], self.yp[i], self.zp[i])
-                for i in range(self.npks)]
+        if self.npks == 0:
+            return []
+        return self.calculate_hkls(self.xp, self.yp, self.zp).tolist()
 
     def hkl(self, i):
         """Return the calculated HKL indices for the specified peak."""
@@ -1504,85 +1694,101 @@ class NXRefine:
         list of NXPeaks
             List of NXPeaks containing the pixel/frame coordinates.
         """
-        v7 = vec(H, K, L)
-        v6 = self.Bmat * v7
-        v5 = self.Umat * v6
+        x, y, z = self.calculate_xyzs(H, K, L)[:3]
+        return [NXPeak(*xyz, H=H, K=K, L=L, parent=self)
+                for xyz in zip(x, y, z)]
 
-        def ewald_condition(phi): return (
-            norm(self.Evec)**2 - norm(self.Gmat(phi)*v5 + self.Evec)**2)
+    def calculate_xyzs(self, H, K, L):
+        """Return the pixel/frame coordinates of a set of HKL indices.
 
-        phis = []
-        if H == 0 and K == 0 and L == 0:
-            pass
-        elif optimize.fsolve(ewald_condition, 45.0, full_output=1)[2] == 1:
-            phis = list(
-                np.unique(
-                    np.around(
-                        [optimize.fsolve(ewald_condition, phi) % 360
-                         for phi in np.arange(30, 390, 15)],
-                        decimals=4)))
-
-        def get_ij(phi):
-            v4 = self.Gmat(phi) * v5
-            p = norm_vec(v4 + self.Evec)
-            v3 = -(self.Dvec(phi)[0, 0] / p[0, 0]) * p
-            v2 = self.Dmat * (v3 + self.Dvec(phi))
-            v1 = (self.Omat * v2 / self.pixel_size) + self.Cvec
-            return v1[0, 0], v1[1, 0]
+        For rotation about phi, the Ewald condition reduces to
+        A cos(phi) + B sin(phi) = C, which is solved analytically for all
+        the reflections at once. Each reflection crosses the Ewald sphere
+        at up to two angles, returned in ascending order.
 
-        peaks = []
-        for phi in phis:
-            x, y = get_ij(phi)
-            z = ((phi - self.phi_start) / self.phi_step) % 3600
-            if z < 25:
-                z = z + 3600
-            elif z > 3625:
-                z = z - 3600
-            if x > 0 and x < self.shape[1] and y > 0 and y < self.shape[0]:
-                peaks.append(NXPeak(x, y, z, H=H, K=K, L=L, parent=self))
-
-        peaks = [peak for peak in peaks if peak.z > 0 and peak.z < 3648]
+        Parameters
+        ----------
+        H, K, L : array_like
+            HKL indices
 
-        return peaks
+        Returns
+        -------
+        tuple of ndarrays
+            Pixel/frame coordinates and HKL indices, (x, y, z, H, K, L),
+            of the reflections that fall on the detector.
+        """
+        H, K, L = (np.ravel(v) for v in np.broadcast_arrays(H, K, L))
+        v5 = np.stack((H, K, L), axis=-1) @ np.asarray(self.UBmat).T
+        Gmat = np.asarray(self._Gmat_cache)
+        A = Gmat[0, 0] * v5[:, 0] + Gmat[0, 1] * v5[:, 1]
+        B = Gmat[0, 1] * v5[:, 0] - Gmat[0, 0] * v5[:, 1]
+        C = (-0.5 * self.wavelength * np.sum(v5**2, axis=1)
+             - Gmat[0, 2] * v5[:, 2])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            delta = np.arccos(C / np.hypot(A, B))
+        offset = np.arctan2(B, A)
+        phis = (np.stack((offset - delta, offset + delta), axis=-1)
+                * degrees) % 360
+        rounded = np.around(phis, decimals=4) % 360
+        order = np.argsort(rounded, axis=1)
+        phis = np.take_along_axis(phis, order, axis=1)
+        rounded = np.take_along_axis(rounded, order, axis=1)
+        found = np.isfinite(delta)
+        found = np.stack((found, found & (rounded[:, 0] != rounded[:, 1])),
+                         axis=-1)
+        i, j = np.nonzero(found)
+        phi, v5, H, K, L = phis[i, j], v5[i], H[i], K[i], L[i]
+
+        R = rotmats(3, phi)
+        p = (np.einsum('nij,nj->ni', R, v5) @ Gmat.T
+             + (1.0 / self.wavelength, 0.0, 0.0))
+        p /= norm(p, axis=1)[:, np.newaxis]
+        Dvec = (R @ np.ravel(self.Svec)) @ Gmat.T - (self.distance, 0.0, 0.0)
+        p, Dvec = p @ np.asarray(self.Dmat).T, Dvec @ np.asarray(self.Dmat).T
+        v2 = -(Dvec[:, 0] / p[:, 0])[:, np.newaxis] * p + Dvec
+        v1 = (v2 @ np.asarray(self.Omat).T / self.pixel_size
+              + (self.xc, self.yc, 0.0))
+        x, y = v1[:, 0], v1[:, 1]
+        z = ((phi - self.phi_start) / self.phi_step) % 3600
+        z = np.where(z < 25, z + 3600, np.where(z > 3625, z - 3600, z))
+        mask = ((x > 0) & (x < self.shape[1]) &
+                (y > 0) & (y < self.shape[0]))
+        return tuple(v[mask] for v in (x, y, z, H, K, L))
 
     def get_xyzs(self, Qh=None, Qk=None, Ql=None):
-        if self.julia is None:
-            try:
-                self.julia = init_julia()
-            except Exception as error:
-                raise NeXusError(str(error))
-        load_julia(['julia/get_xyzs.jl'])
-        from julia import Main, Pkg
-        Pkg.add("Roots")
-        Main.Gmat0 = np.array(self.Gmat(0.0))
-        Main.UBmat = np.array(self.UBmat)
-        Main.Dmat = np.array(self.Dmat)
-        Main.Omat = np.array(self.Omat) / self.pixel_size
-        Main.Cvec = list(np.array(self.Cvec.T).reshape((3)))
-        Main.Dvec = list(np.array(self.Dvec().T).reshape((3)))
-        Main.Evec = list(np.array(self.Evec.T).reshape((3)))
-        Main.shape = self.shape
+        """Return the predicted Bragg peaks within a range of HKL indices.
+
+        Systematically absent reflections are excluded.
+
+        Parameters
+        ----------
+        Qh, Qk, Ql : int, optional
+            Maximum absolute values of the H, K, and L indices, by default
+            the limits of the transform grid.
+
+        Returns
+        -------
+        list of NXPeaks
+            List of NXPeaks containing the pixel/frame coordinates.
+        """
         if Qh is None:
             Qh = int(self.Qh[-1])
         if Qk is None:
             Qk = int(self.Qk[-1])
         if Ql is None:
             Ql = int(self.Ql[-1])
-        ps = self.julia.get_xyzs(Qh, Qk, Ql)
+        L, K, H = np.mgrid[-Ql:Ql+1, -Qk:Qk+1, -Qh:Qh+1]
         peaks = []
-        for p in ps:
-            try:
-                H, K, L = p[3], p[4], p[5]
-                if not self.absent(H, K, L):
-                    peaks.append(NXPeak(*p[0:3], H=H, K=K, L=L, parent=self))
-            except Exception:
-                pass
+        for x, y, z, H, K, L in zip(*self.calculate_xyzs(H, K, L)):
+            H, K, L = int(H), int(K), int(L)
+            if not self.absent(H, K, L):
+                peaks.append(NXPeak(x, y, z, H=H, K=K, L=L, parent=self))
         return peaks
 
     def polar(self, i):
         """Return the polar angle in degrees for the specified Bragg peak."""
-        Oimat = inv(self.Omat)
-        Mat = self.pixel_size * inv(self.Dmat) * Oimat
+        Oimat = self.Oimat
+        Mat = self.pixel_size * self.Dimat * Oimat
         peak = Oimat * (vec(self.xp[i], self.yp[i]) - self.Cvec)
         v = norm(Mat * peak)
         return np.arctan(v / self.distance)
@@ -1608,8 +1814,10 @@ class NXRefine:
         """Define the peaks whose positions are within the HKL tolerance."""
         if hkl_tolerance is None:
             hkl_tolerance = self.hkl_tolerance
-        _idx = list(np.where(self.polar_angle < self.polar_max)[0])
-        self._idx = [i for i in _idx if self.diff(i) < hkl_tolerance]
+        _idx = np.where(self.polar_angle < self.polar_max)[0]
+        diffs = self.calculate_diffs(self.calculate_hkls(
+            self.xp[_idx], self.yp[_idx], self.zp[_idx]))
+        self._idx = list(_idx[diffs < hkl_tolerance])
 
     @property
     def weights(self):
@@ -1618,7 +1826,242 @@ class NXRefine:
 
     def diffs(self):
         """Return all the deviations from the calculated peak positions."""
-        return np.array([self.diff(i) for i in self.idx])
+        if self.Umat is None:
+            return self.calculate_diffs(np.zeros((len(self.idx), 3)))
+        g = self._geometry()
+        return self.calculate_diffs(self._peak_terms(g)['G']
+                                    @ g['UBimat'].T)
+
+    def calculate_diffs(self, hkls):
+        """Return the deviations of HKL values from the nearest integers.
+
+        This is the vectorized form of `diff`. The deviations are
+        calculated in reciprocal Å, and the smaller of the deviations of
+        the HKL values and of their twinned values is returned.
+
+        Parameters
+        ----------
+        hkls : array_like
+            Array of shape (N, 3) containing the calculated HKL values.
+
+        Returns
+        -------
+        ndarray
+            Deviations of each set of HKL values.
+        """
+        Q = np.reshape(hkls, (-1, 3))
+        Bmat = np.asarray(self.Bmat)
+        diffs = norm((Q - np.rint(Q)) @ Bmat.T, axis=1)
+        p_mat = self.twin_matrix
+        if p_mat is not None:
+            Q_twin = Q @ p_mat.T
+            twin_diffs = norm((Q_twin - np.rint(Q_twin)) @ Bmat.T, axis=1)
+            diffs = np.minimum(twin_diffs, diffs)
+        return diffs
+
+    @property
+    def twin_matrix(self):
+        """Return the matrix transforming HKL values into the twin domain.
+
+        None is returned if twins are not included in the HKL deviations.
+        """
+        TWIN = True # Flag for twins
+        if TWIN: # does not work if more than one twin
+            beta = self.beta / 180.0 * np.pi
+            return np.array(((-1, 0, 2 * self.a / self.c * np.cos(beta)),
+                             (0, -1, 0),
+                             (0, 0, 1)))
+        else:
+            return None
+
+    def diffs_jacobian(self, names):
+        """Return the derivatives of the HKL deviations of the peaks.
+
+        The derivatives are calculated analytically for all the peaks
+        returned by `diffs` using the chain rule. The derivative of each
+        deviation with respect to every value in the geometry returned by
+        `_geometry` is calculated once, so the derivatives with respect
+        to all the parameters are obtained from the derivatives of the
+        geometry in a few matrix products.
+
+        Parameters
+        ----------
+        names : list of str
+            Names of the parameters, which are either NXRefine attributes
+            or elements of the orientation matrix, e.g., 'U01'.
+
+        Returns
+        -------
+        ndarray
+            Array of shape (N, M) containing the derivatives of the N
+            deviations with respect to the M parameters.
+        """
+        def outer(x, y):
+            return np.einsum('ni,nj->nij', x, y).reshape(-1, 9)
+
+        g = self._geometry()
+        terms = self._peak_terms(g)
+        dg = {}
+        for i, name in enumerate(names):
+            for key, value in self._geometry_derivative(name, g).items():
+                if key not in dg:
+                    dg[key] = np.zeros((len(names), np.size(g[key])))
+                dg[key][i] = np.ravel(value)
+
+        G = terms['G']
+        Q = G @ g['UBimat'].T
+        dQ0 = Q - np.rint(Q)
+        e = dQ0 @ g['Bmat'].T
+        r = norm(e, axis=1)
+        twin = g['Tmat'] is not None
+        if twin:
+            Qt = Q @ g['Tmat'].T
+            dQt0 = Qt - np.rint(Qt)
+            et = dQt0 @ g['Bmat'].T
+            rt = norm(et, axis=1)
+            use_twin = (rt < r)[:, np.newaxis]
+            r = np.where(use_twin[:, 0], rt, r)
+        else:
+            dQt0, et = dQ0, e
+            use_twin = np.zeros((len(r), 1), dtype=bool)
+        r = np.where(r > 0, r, np.inf)[:, np.newaxis]
+        e = np.where(use_twin, et, e) / r
+        eB = e @ g['Bmat']
+        if twin:
+            eQ = np.where(use_twin, eB @ g['Tmat'], eB)
+        else:
+            eQ = eB
+        # Derivatives of the deviations with respect to each value in the
+        # geometry, which are multiplied by the derivatives of the values
+        weights = {'UBimat': lambda: outer(eQ, G),
+                   'Bmat': lambda: outer(e, np.where(use_twin, dQt0, dQ0)),
+                   'Tmat': lambda: outer(np.where(use_twin, eB, 0.0), Q)}
+        keys = [key for key in dg if np.any(dg[key])]
+
+        if any(key not in weights for key in keys):
+            z, R, pixels, v3, u, GTu = (terms[k] for k in
+                                        ('z', 'R', 'pixels', 'v3', 'u', 'GTu'))
+            eG = eQ @ g['UBimat']
+            eR = np.einsum('nji,ni->nj', R, eG)
+            a = eR @ g['Gmat'].T / g['wavelength']
+            v3_norm = norm(v3, axis=1)[:, np.newaxis]
+            n = v3 / v3_norm
+            ev = (a - n * np.sum(n * a, axis=1)[:, np.newaxis]) / v3_norm
+            evG = ev @ g['Gmat']
+
+            @lru_cache(maxsize=None)
+            def phi():
+                angles = (g['phi'] + g['phi_step'] * z) * radians
+                dR = np.zeros_like(R)
+                dR[:, 0, 0] = dR[:, 1, 1] = -np.sin(angles) * radians
+                dR[:, 1, 0] = np.cos(angles) * radians
+                dR[:, 0, 1] = -dR[:, 1, 0]
+                return (np.sum(np.einsum('nji,ni->nj', dR, eG) * GTu, axis=1)
+                        - np.sum(evG * (dR @ g['Svec']), axis=1))
+
+            weights.update({
+                'xc': lambda: -ev @ g['Mat'][:, :1],
+                'yc': lambda: -ev @ g['Mat'][:, 1:2],
+                'distance': lambda: ev[:, :1],
+                'wavelength': lambda: -np.sum(a * u, axis=1, keepdims=True),
+                'Mat': lambda: outer(ev, pixels),
+                'Gmat': lambda: outer(u, eR) - outer(ev, R @ g['Svec']),
+                'Svec': lambda: -np.einsum('nji,nj->ni', R, evG),
+                'phi': lambda: phi()[:, np.newaxis],
+                'phi_step': lambda: (phi() * z)[:, np.newaxis]})
+
+        jacobian = np.zeros((len(G), len(names)))
+        for key in keys:
+            jacobian += weights[key]() @ dg[key].T
+        return jacobian
+
+    def _geometry(self):
+        """Return the matrices and vectors that define the peak HKLs."""
+        Mat = self.pixel_size * self.Dimat * self.Oimat
+        return {'xc': self.xc, 'yc': self.yc,
+                'phi': self.phi, 'phi_step': self.phi_step,
+                'distance': self.distance, 'wavelength': self.wavelength,
+                'Mat': np.asarray(Mat), 'Gmat': np.asarray(self._Gmat_cache),
+                'Svec': np.ravel(self.Svec),
+                'UBimat': np.asarray(self.UBimat),
+                'Bmat': np.asarray(self.Bmat), 'Tmat': self.twin_matrix}
+
+    def _geometry_derivative(self, name, geometry):
+        """Return the derivatives of the geometry.
+
+        The derivatives with respect to the parameters that define the
+        geometry are analytic, except for the derivatives of the B and
+        twin matrices with respect to the lattice parameters, which
+        depend on the crystal symmetry. These, and the derivatives with
+        respect to any other parameter, are calculated numerically. Only
+        the values of the geometry that depend on the parameter are
+        included.
+        """
+        def rotations(angles):
+            return np.linalg.multi_dot(
+                [rotmat_derivative(axis, getattr(self, angle))
+                 if angle == name else np.asarray(rotmat(axis,
+                                                         getattr(self, angle)))
+                 for angle, axis in angles.items()])
+
+        UBimat = geometry['UBimat']
+        goniometer = {'theta': 2, 'omega': 3, 'chi': 1}
+        detector = {'roll': 1, 'pitch': 2, 'yaw': 3}
+        if name in ('xc', 'yc', 'phi', 'phi_step', 'distance', 'wavelength'):
+            return {name: 1.0}
+        elif name in ('xs', 'ys', 'zs'):
+            return {'Svec': np.eye(3)['xyz'.index(name[0])]}
+        elif name == 'pixel_size':
+            return {'Mat': geometry['Mat'] / self.pixel_size}
+        elif name in goniometer:
+            return {'Gmat': rotations(goniometer)}
+        elif name in detector:
+            return {'Mat': self.pixel_size * rotations(detector)
+                    @ np.asarray(self.Oimat)}
+        elif self._is_orientation_element(name):
+            E = np.zeros((3, 3))
+            E[int(name[1]), int(name[2])] = 1.0
+            return {'UBimat': -UBimat @ E @ geometry['Bmat'] @ UBimat}
+        elif name in ('a', 'b', 'c', 'alpha', 'beta', 'gamma'):
+            def matrices():
+                return {'Bmat': np.asarray(self.Bmat),
+                        'Tmat': self.twin_matrix}
+        else:
+            matrices = self._geometry
+        value = self._parameter_value(name)
+        step = 1e-6 * max(1.0, abs(value))
+        try:
+            self._parameter_value(name, value + step)
+            upper = matrices()
+            self._parameter_value(name, value - step)
+            lower = matrices()
+        finally:
+            self._parameter_value(name, value)
+        derivative = {key: ((np.asarray(upper[key]) - np.asarray(lower[key]))
+                            / (2 * step))
+                      for key in upper if upper[key] is not None}
+        if 'UBimat' not in derivative:
+            derivative['UBimat'] = (-UBimat @ np.asarray(self.Umat)
+                                    @ derivative['Bmat'] @ UBimat)
+        return derivative
+
+    @staticmethod
+    def _is_orientation_element(name):
+        """Return True if the parameter is an orientation matrix element."""
+        return len(name) == 3 and name[0] == 'U' and name[1:].isdigit()
+
+    def _parameter_value(self, name, value=None):
+        """Return or set the value of a refined parameter."""
+        if self._is_orientation_element(name):
+            i, j = int(name[1]), int(name[2])
+            if value is not None:
+                self.Umat[i, j] = value
+            return self.Umat[i, j]
+        else:
+            if value is not None:
+                setattr(self, name, value)
+                self.set_symmetry()
+            return getattr(self, name)
 
     def diff(self, i):
         """Return the deviation from the calculated peak position.
@@ -1636,29 +2079,17 @@ class NXRefine:
         float
             [description]
         """
-        
-        H, K, L = self.hkl(i)
-        Q = np.matrix((H, K, L)).T
-        Q0 = np.matrix((np.rint(H), np.rint(K), np.rint(L))).T
-        TWIN = True # Flag for twins
-        if TWIN: # does not work if more than one twin
-            # update lattice parameters?
-            a = self.a
-            c = self.c
-            beta = self.beta / 180.0 * np.pi
-            p_mat = np.matrix(((-1, 0, 2 * a / c * np.cos(beta)),
-                           (0, -1, 0),
-                           (0, 0, 1)))
-            Q_twin = p_mat @ Q
-            Q0_twin = np.rint(Q_twin)
-            return min(norm(self.Bmat * (Q_twin - Q0_twin)),
-                       norm(self.Bmat * (Q - Q0)))
-        else: # No twins
-            return norm(self.Bmat * (Q - Q0))
+        return self.calculate_diffs(self.hkl(i))[0]
 
     def angle_diffs(self):
         """Return the set of polar angle differences for all the peaks"""
-        return np.array([self.angle_diff(i) for i in self.idx])
+        idx = self.idx
+        hkls = np.rint(self.calculate_hkls(self.xp[idx], self.yp[idx],
+                                           self.zp[idx])).astype(int)
+        polar = self.calculate_angles(self.xp[idx], self.yp[idx])[0]
+        polar0 = np.array([self.unit_cell.two_theta(hkl, self.wavelength)
+                           for hkl in map(tuple, hkls.tolist())])
+        return np.abs(polar * radians - polar0)
 
     def angle_diff(self, i):
         """Return the deviation from the calculated peak position in degrees.
@@ -1695,7 +2126,7 @@ class NXRefine:
             H = np.array(H)[peaks]
             K = np.array(K)[peaks]
             L = np.array(L)[peaks]
-            diffs = np.array([self.diff(i) for i in peaks])
+            diffs = self.calculate_diffs(np.stack((H, K, L), axis=-1))
         else:
             H = K = L = diffs = np.zeros(peaks.shape, dtype=float)
         return list(zip(peaks, x, y, z, polar, azi, intensity, H, K, L, diffs))
@@ -1785,7 +2216,9 @@ class NXRefine:
         p0 = self.define_parameters(**opts)
         if len(p0) == 0:
             raise NeXusError('No parameters selected for refinement')
-        self.result = minimize(self.hkl_residuals, p0, method=method)
+        self.result = minimize(self.hkl_residuals, p0, method=method,
+                               **self.jacobian_options(method,
+                                                       self.hkl_jacobian))
         self.fit_report = fit_report(self.result)
         if self.result.success:
             self.get_parameters(self.result.params)
@@ -1806,6 +2239,47 @@ class NXRefine:
         self.get_parameters(parameters)
         return self.diffs()
 
+    def hkl_jacobian(self, parameters):
+        """Return the derivatives of the HKL residuals.
+
+        Parameters
+        ----------
+        parameters : lmfit.Parameters
+            The set of parameters to be optimized by LMFIT.
+
+        Returns
+        -------
+        array_like
+            An array of the derivatives of the residuals with respect to
+            each varying parameter.
+        """
+        self.get_parameters(parameters)
+        return self.diffs_jacobian([p for p in parameters
+                                    if parameters[p].vary])
+
+    @staticmethod
+    def jacobian_options(method, jacobian):
+        """Return the LMFIT keyword arguments defining the Jacobian.
+
+        The Jacobian function is only used by minimizers that accept it.
+
+        Parameters
+        ----------
+        method : str
+            LMFIT minimizer method.
+        jacobian : function
+            Function returning the derivatives of the residuals.
+
+        Returns
+        -------
+        dict
+            Keyword arguments to be passed to `lmfit.minimize`.
+        """
+        if method in ('leastsq', 'least_squares'):
+            return {'Dfun': jacobian}
+        else:
+            return {}
+
     def refine_angles(self, method='nelder', **opts):
         """Refine parameters based on the calculated polar angles.
 
@@ -1885,7 +2359,9 @@ class NXRefine:
         self.set_idx()
         from lmfit import fit_report, minimize
         p0 = self.define_orientation_matrix()
-        self.result = minimize(self.orient_residuals, p0, method=method)
+        self.result = minimize(self.orient_residuals, p0, method=method,
+                               **self.jacobian_options(method,
+                                                       self.orient_jacobian))
         self.fit_report = fit_report(self.result)
         if self.result.success:
             self.get_orientation_matrix(self.result.params)
@@ -1910,6 +2386,23 @@ class NXRefine:
         self.get_orientation_matrix(p)
         return self.diffs()
 
+    def orient_jacobian(self, p):
+        """Return the derivatives of the HKL residuals.
+
+        Parameters
+        ----------
+        parameters : lmfit.Parameters
+            The set of parameters to be optimized by LMFIT.
+
+        Returns
+        -------
+        array_like
+            An array of the derivatives of the residuals with respect to
+            each element of the orientation matrix.
+        """
+        self.get_orientation_matrix(p)
+        return self.diffs_jacobian([name for name in p if p[name].vary])
+
     def get_polarization(self, beam_polarization=0.99):
         """Return the synchrotron x-ray polarization across the detector.
 
@@ -1926,20 +2419,10 @@ class NXRefine:
         if 'polarization' in self.entry['instrument/detector']:
             return self.entry['instrument/detector/polarization'].nxvalue
         elif 'calibration' in self.entry['instrument']:
-            from pyFAI.azimuthalIntegrator import AzimuthalIntegrator
-            parameters = (
-                self.entry['instrument/calibration/refinement/parameters'])
-            ai = AzimuthalIntegrator(
-                dist=parameters['Distance'].nxvalue,
-                poni1=parameters['Poni1'].nxvalue,
-                poni2=parameters['Poni2'].nxvalue,
-                rot1=parameters['Rot1'].nxvalue,
-                rot2=parameters['Rot2'].nxvalue,
-                rot3=parameters['Rot3'].nxvalue,
-                pixel1=parameters['PixelSize1'].nxvalue,
-                pixel2=parameters['PixelSize2'].nxvalue,
-                wavelength=parameters['Wavelength'].nxvalue)
-            return ai.polarization(shape=self.shape, factor=beam_polarization)
+            calibration = get_calibration(
+                self.entry['instrument/calibration/refinement/parameters'],
+                shape=self.shape, detector=False)
+            return calibration.polarization(beam_polarization)
         else:
             return 1
 
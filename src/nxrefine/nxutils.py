@@ -5,15 +5,659 @@
 #
 # The full license is in the file COPYING, distributed with this software.
 # -----------------------------------------------------------------------------
-from concurrent.futures import ProcessPoolExecutor, as_completed
-from multiprocessing import get_context
+import hashlib
+import logging
+import os
+import queue
+import threading
+import timeit
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor,
+                                as_completed, wait)
+from multiprocessing import get_context, shared_memory
+
+import h5py as h5
 import numpy as np
-from nexusformat.nexus import (NXdata, NXentry, NXfield, NXlog, NXroot, nxopen,
-                               nxsetconfig)
+import psutil
+from nexusformat.nexus import (NXcollection, NXdata, NXentry, NXfield, NXlog,
+                               NXroot, nxopen, nxsetconfig)
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
 from skimage.feature import peak_local_max
 
+peak_dtype = np.dtype([('x', np.float64), ('y', np.float64),
+                       ('z', np.float64), ('sigx', np.float64),
+                       ('sigy', np.float64), ('sigz', np.float64),
+                       ('intensity', np.float64), ('max_value', np.float64)])
+"""NumPy structured array type used to store tables of Bragg peaks."""
 
-def peak_search(data_file, data_path, i, j, k, threshold, min_pixels=10):
+_worker_files = {}
+"""Files opened once in each worker process by `init_worker`."""
+
+_worker_buffers = {}
+"""Shared frame buffers attached in each worker process by `init_worker`."""
+
+_calibrations = {}
+"""Powder calibrations shared by all the entries using them."""
+
+
+def init_worker(data_file, buffer=None, swmr=False):
+    """Open the files shared by all the tasks run in a worker process.
+
+    This is used as the initializer of an `NXExecutor`, so that each
+    worker process opens the raw data file once, instead of once per
+    task. The raw data file is opened read-only with h5py.
+
+    Parameters
+    ----------
+    data_file : str
+        File path to the raw data file
+    buffer : tuple, optional
+        Specification of an `NXFrameBuffer` containing frames of the raw
+        data, returned by `NXFrameBuffer.spec`, by default None
+    swmr : bool, optional
+        Open the raw data file in SWMR mode, so that frames can be read
+        while the file is still being written, by default False
+    """
+    nxsetconfig(lock=3600, lockexpiry=28800)
+    if swmr:
+        _worker_files[data_file] = h5.File(data_file, 'r', libver='latest',
+                                           swmr=True)
+    else:
+        _worker_files[data_file] = h5.File(data_file, 'r')
+    if buffer is not None:
+        _worker_buffers[data_file] = NXFrameBuffer(*buffer)
+
+
+def read_frames(data_file, data_path, j, k, slab=None):
+    """Return frames j to k of the raw data.
+
+    If a slab that has already been read, e.g., by `reduce_slab` or
+    `NXPrefetcher`, is given, a view of that slab is returned. If a
+    shared frame buffer has been attached by `init_worker`, the frames
+    are taken from the buffer. If the file has been opened by
+    `init_worker`, the cached file handle is used, after refreshing it
+    if it was opened in SWMR mode. Otherwise, the file is opened for
+    this read only.
+
+    Parameters
+    ----------
+    data_file : str
+        File path to the raw data file
+    data_path : str
+        Internal path to the raw data
+    j : int
+        Index of first frame
+    k : int
+        Index of last frame
+    slab : tuple, optional
+        Index of the first frame and the frames of a slab that has
+        already been read, which must contain frames j to k, by default
+        None
+
+    Returns
+    -------
+    ndarray
+        Slab of raw data
+    """
+    if slab is not None:
+        start, frames = slab
+        if j < start or k > start + len(frames):
+            raise ValueError(
+                f"Frames {j} to {k} are not in the slab starting at {start}")
+        return frames[j-start:k-start]
+    if data_file in _worker_buffers:
+        return _worker_buffers[data_file].read(j, k)
+    if data_file in _worker_files:
+        dataset = _worker_files[data_file][data_path]
+        if dataset.file.swmr_mode:
+            dataset.refresh()
+        return dataset[j:k]
+    nxsetconfig(lock=3600, lockexpiry=28800)
+    with nxopen(data_file, 'r') as data_root:
+        return data_root[data_path][j:k].nxvalue
+
+
+def masked_frames(data_file, data_path, j, k, pixel_mask=None, slab=None):
+    """Return frames j to k of the raw data prepared for a peak search.
+
+    The frames are returned by `read_frames`, with negative values
+    clipped to zero and the masked pixels set to zero. The result is a
+    copy, so it can be modified without changing the raw data or any
+    slab that has already been read.
+
+    Parameters
+    ----------
+    data_file : str
+        File path to the raw data file
+    data_path : str
+        Internal path to the raw data
+    j : int
+        Index of first frame
+    k : int
+        Index of last frame
+    pixel_mask : array-like, optional
+        2D detector mask. Masked pixels, with values of 1, are set to
+        zero, by default None
+    slab : tuple, optional
+        Index of the first frame and the frames of a slab that has
+        already been read, passed to `read_frames`, by default None
+
+    Returns
+    -------
+    ndarray
+        Slab of raw data
+    """
+    data = read_frames(data_file, data_path, j, k, slab=slab).clip(0)
+    if pixel_mask is not None:
+        data[:, np.asarray(pixel_mask, dtype=bool)] = 0
+    return data
+
+
+def plan_slabs(first, last, shape, chunks=None, halo=0, stop=None,
+               workers=1, bytes_per_pixel=16, min_frames=None,
+               memory=None, buffer_bytes_per_pixel=0):
+    """Divide a range of frames into slabs aligned with the HDF5 chunks.
+
+    The number of frames in each slab is chosen to give each worker
+    several slabs, while keeping the total memory required by all the
+    workers, and by any shared frame buffer holding their slabs, within
+    half the available memory. It is then rounded to a
+    multiple of the chunk size along z, and the slab boundaries are
+    placed on chunk boundaries, so that only the halo frames require
+    chunks to be read by more than one task.
+
+    Parameters
+    ----------
+    first : int
+        First frame to be processed
+    last : int
+        Last frame to be processed
+    shape : tuple of ints
+        Shape of the raw data
+    chunks : tuple of ints, optional
+        Chunk shape of the raw data, by default None
+    halo : int, optional
+        Number of frames added to each side of a slab, by default 0
+    stop : int, optional
+        Upper limit of the frames read in any slab, by default the number
+        of frames in the raw data
+    workers : int, optional
+        Number of processes sharing the work, by default 1
+    bytes_per_pixel : int, optional
+        Memory required to process each pixel of a slab, by default 16
+    min_frames : int, optional
+        Minimum number of frames in a slab, by default the larger of the
+        chunk size and ten times the halo, to keep the fraction of frames
+        read twice small
+    memory : int, optional
+        Available memory in bytes, by default the value returned by
+        `psutil.virtual_memory`
+    buffer_bytes_per_pixel : int, optional
+        Bytes per pixel of an `NXFrameBuffer` holding the frames of one
+        more slab than the number of workers, by default 0, i.e., no
+        frame buffer is used
+
+    Returns
+    -------
+    list of tuples
+        List of (i, j, k) values, where i is the first output frame of
+        each slab, and j and k are the limits of the frames to be read.
+        The output frames of each slab end at the first output frame of
+        the next slab.
+    """
+    nframes = shape[0]
+    if stop is None:
+        stop = nframes
+    if chunks:
+        chunk_size = chunks[0]
+    else:
+        chunk_size = 1
+    if min_frames is None:
+        min_frames = max(chunk_size, 10 * halo)
+    if memory is None:
+        memory = psutil.virtual_memory().available
+    pixels = int(np.prod(shape[1:]))
+    slab_bytes = pixels * (workers * bytes_per_pixel +
+                           (workers + 1) * buffer_bytes_per_pixel)
+    max_frames = max(int(memory / 2 / slab_bytes) - 2 * halo, chunk_size)
+    total = last + 1 - first
+    size = max(int(np.ceil(total / (4 * workers))), min_frames)
+    size = max(int(np.ceil(size / chunk_size)), 1) * chunk_size
+    while size > max_frames and size > chunk_size:
+        size -= chunk_size
+    starts = [first] + list(range((first // size + 1) * size, last + 1, size))
+    ends = starts[1:] + [last + 1]
+    return [(i, max(i - halo, 0), min(l + halo, stop))
+            for i, l in zip(starts, ends)]
+
+
+class NXFrameBuffer:
+    """Ring buffer of raw data frames in shared memory.
+
+    Frame z is stored in slot z % size, so a buffer of `size` frames can
+    hold any range of up to `size` consecutive frames. The buffer is
+    created by the parent process and attached by each worker using the
+    values returned by `spec`.
+
+    Parameters
+    ----------
+    size : int
+        Number of frames held in the buffer
+    frame_shape : tuple of ints
+        Shape of each frame
+    dtype : str or dtype
+        Data type of the frames
+    name : str, optional
+        Name of an existing shared memory block to attach, by default
+        None, in which case a new block is created
+    """
+
+    def __init__(self, size, frame_shape, dtype, name=None):
+        self.size = int(size)
+        self.frame_shape = tuple(frame_shape)
+        self.dtype = np.dtype(dtype)
+        nbytes = (self.size * int(np.prod(self.frame_shape))
+                  * self.dtype.itemsize)
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+            self.owner = True
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        self.frames = np.ndarray((self.size,) + self.frame_shape,
+                                 dtype=self.dtype, buffer=self.shm.buf)
+
+    def __repr__(self):
+        return f"NXFrameBuffer(size={self.size}, name='{self.shm.name}')"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def spec(self):
+        """Arguments used to attach the buffer in another process."""
+        return (self.size, self.frame_shape, self.dtype.str, self.shm.name)
+
+    def _ranges(self, j, k):
+        """Split frames j to k into ranges that do not wrap around."""
+        while j < k:
+            start = j % self.size
+            stop = min(start + k - j, self.size)
+            yield j, start, stop
+            j += stop - start
+
+    def load(self, dataset, j, k):
+        """Decompress frames j to k of the dataset into the buffer.
+
+        Parameters
+        ----------
+        dataset : h5py.Dataset
+            Raw data.
+        j : int
+            Index of first frame
+        k : int
+            Index of last frame
+        """
+        for z, start, stop in self._ranges(j, k):
+            dataset.read_direct(self.frames,
+                                np.s_[z:z+stop-start],
+                                np.s_[start:stop])
+
+    def read(self, j, k):
+        """Return frames j to k from the buffer.
+
+        A view of the buffer is returned unless the frames wrap around
+        the end of the buffer, in which case they are copied.
+        """
+        ranges = list(self._ranges(j, k))
+        if len(ranges) == 1:
+            return self.frames[ranges[0][1]:ranges[0][2]]
+        return np.concatenate([self.frames[start:stop]
+                               for _, start, stop in ranges])
+
+    def close(self):
+        """Release the buffer, unlinking it if this process created it."""
+        self.frames = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def load_frames(data_file, data_path, j, k):
+    """Decompress frames j to k of the raw data into the shared buffer.
+
+    This is run in a worker process, which has opened the raw data file
+    and attached the buffer with `init_worker`.
+
+    Parameters
+    ----------
+    data_file : str
+        File path to the raw data file
+    data_path : str
+        Internal path to the raw data
+    j : int
+        Index of first frame
+    k : int
+        Index of last frame
+    """
+    dataset = _worker_files[data_file][data_path]
+    _worker_buffers[data_file].load(dataset, j, k)
+
+
+def run_slabs(executor, task, slabs, buffer=None, data_file=None,
+              data_path=None):
+    """Run a task on each slab and yield the results as they complete.
+
+    Each task is submitted as `task(i, j, k)`. If a frame buffer is
+    given, the frames of each slab that are not already in the buffer
+    are first decompressed into it by `load_frames` tasks, split at
+    chunk boundaries so that the workers decompress them in parallel.
+    Each frame is loaded once, and a slab is only submitted when all the
+    frames it reads have been loaded. A slab is only loaded when the
+    buffer has room for it without overwriting frames still in use by
+    earlier slabs. The workers are expected to attach the buffer with
+    `init_worker`.
+
+    Parameters
+    ----------
+    executor : NXExecutor
+        Executor running the tasks.
+    task : callable
+        Function called with the values of i, j and k of each slab.
+    slabs : list of tuples
+        Values of (i, j, k) returned by `plan_slabs`.
+    buffer : NXFrameBuffer, optional
+        Shared buffer holding the frames, by default None
+    data_file : str, optional
+        File path to the raw data file, by default None
+    data_path : str, optional
+        Internal path to the raw data, by default None
+
+    Yields
+    ------
+    object
+        Result of each task.
+    """
+    slabs = list(slabs)
+    futures = {}
+    waiting = []
+    loading = []
+    loaded = None
+    if buffer is not None:
+        with h5.File(data_file, 'r') as raw_file:
+            chunks = raw_file[data_path].chunks
+        chunk_size = chunks[0] if chunks else 1
+    while slabs or waiting or futures:
+        while slabs:
+            i, j, k = slabs[0]
+            if buffer is None:
+                futures[executor.submit(task, i, j, k)] = slabs.pop(0)
+                continue
+            start = min([s[1] for s in futures.values()] +
+                        [s[1] for s, _ in waiting] + [j])
+            if k - start > buffer.size:
+                if not futures and not waiting:
+                    raise ValueError(
+                        "Frame buffer is too small for the slab size")
+                break
+            if loaded is None or loaded < j:
+                loaded = j
+            if k > loaded:
+                size = int(np.ceil((k - loaded) / executor.max_workers
+                                   / chunk_size)) * chunk_size
+                edges = ([loaded] +
+                         list(range((loaded // size + 1) * size, k, size)) +
+                         [k])
+                for a, b in zip(edges[:-1], edges[1:]):
+                    loading.append((a, b, executor.submit(
+                        load_frames, data_file, data_path, a, b)))
+                loaded = k
+            waiting.append((slabs.pop(0),
+                            [f for a, b, f in loading if a < k and b > j]))
+            loading = [(a, b, f) for a, b, f in loading if not f.done()]
+        while waiting and all(f.done() for f in waiting[0][1]):
+            slab, loads = waiting.pop(0)
+            for future in loads:
+                future.result()
+            futures[executor.submit(task, *slab)] = slab
+        pending = set(futures).union(
+            *[[f for f in loads if not f.done()] for _, loads in waiting])
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future in futures:
+                del futures[future]
+                yield future.result()
+
+
+class NXPrefetcher:
+    """Iterate over slabs of raw data, reading the next slabs in advance.
+
+    The frames of each slab are read and decompressed on a background
+    thread, while the previous slab is being processed. The number of
+    slabs held in memory is limited to one more than the number read in
+    advance. The loop yields the values of (i, j, k) of each slab,
+    followed by its frames, which can be passed to `read_frames` as
+    `slab=(j, frames)` to avoid reading the file again. The frames are
+    released when the next slab is requested.
+
+    Parameters
+    ----------
+    data_file : str
+        File path to the raw data file
+    data_path : str
+        Internal path to the raw data
+    slabs : list of tuples
+        Values of (i, j, k) returned by `plan_slabs`.
+    depth : int, optional
+        Number of slabs read in advance, by default 1
+
+    Attributes
+    ----------
+    wait_time : float
+        Time in seconds spent waiting for slabs to be read.
+    read_time : float
+        Time in seconds spent reading the slabs.
+    """
+
+    def __init__(self, data_file, data_path, slabs, depth=1):
+        self.data_file = data_file
+        self.data_path = data_path
+        self.slabs = list(slabs)
+        self.depth = depth
+        self.wait_time = 0.0
+        self.read_time = 0.0
+
+    def __repr__(self):
+        return (f"NXPrefetcher('{self.data_file}', slabs={len(self.slabs)}, "
+                f"depth={self.depth})")
+
+    def __iter__(self):
+        frames = queue.Queue()
+        slots = threading.Semaphore(self.depth + 1)
+        stop = threading.Event()
+        reader = threading.Thread(target=self._read,
+                                  args=(frames, slots, stop), daemon=True)
+        reader.start()
+        try:
+            for i, j, k in self.slabs:
+                tic = timeit.default_timer()
+                slab = frames.get()
+                self.wait_time += timeit.default_timer() - tic
+                if isinstance(slab, Exception):
+                    raise slab
+                try:
+                    yield i, j, k, slab
+                finally:
+                    del slab
+                    slots.release()
+        finally:
+            stop.set()
+            reader.join()
+
+    def _read(self, frames, slots, stop):
+        try:
+            with h5.File(self.data_file, 'r') as raw_file:
+                dataset = raw_file[self.data_path]
+                for _, j, k in self.slabs:
+                    while not slots.acquire(timeout=0.1):
+                        if stop.is_set():
+                            return
+                    if stop.is_set():
+                        return
+                    tic = timeit.default_timer()
+                    frames.put(dataset[j:k])
+                    self.read_time += timeit.default_timer() - tic
+        except Exception as error:
+            frames.put(error)
+
+
+def reduce_slab(data_file, data_path, i, j, k, reducers, slab=None):
+    """Read a slab of raw data once and pass it to several tasks.
+
+    Each task is called with the same arguments as a task submitted to
+    `run_slabs`, but with its own limits for the frames it requires,
+    which must lie within the slab. The slab is passed to each task as
+    the keyword argument `slab`, so that its calls to `read_frames`
+    return views of the frames that have already been read. The tasks
+    must not modify the frames in place.
+
+    Parameters
+    ----------
+    data_file : str
+        File path to the raw data file
+    data_path : str
+        Internal path to the raw data
+    i : int
+        Index of first z-value of the output
+    j : int
+        Index of first z-value of the slab
+    k : int
+        Index of last z-value of the slab
+    reducers : list of tuples
+        List of (task, frames) values, where task is called as
+        `task(i, j, k, slab=slab)` and returns the value of i and its
+        result, and frames is a dictionary of the (j, k) limits used by
+        the task, with the values of i as keys.
+    slab : tuple, optional
+        Index of the first frame and the frames of the slab, if it has
+        already been read, by default None
+
+    Returns
+    -------
+    int, list
+        Index of the first z-value and the results of each task
+    """
+    slab = (j, read_frames(data_file, data_path, j, k, slab=slab))
+    return i, [task(i, *frames[i], slab=slab)[1]
+               for task, frames in reducers]
+
+
+def maximum_slab(data_file, data_path, i, j, k, frame_weights,
+                 partial_weights, slab=None):
+    """Return the summed frames and pixel extrema of a slab of raw data.
+
+    Masked arrays are avoided by precomputing boolean weights for the
+    pixels included in the frame sums. Each weighted sum is calculated
+    from whichever of the included or excluded pixels is the smaller
+    set.
+
+    Parameters
+    ----------
+    data_file : str
+        File path to the raw data file
+    data_path : str
+        Internal path to the raw data
+    i : int
+        Index of first z-value of output
+    j : int
+        Index of first z-value of processed slab
+    k : int
+        Index of last z-value of processed slab
+    frame_weights : array-like
+        2D boolean array of the pixels included in the frame sums.
+    partial_weights : array-like
+        2D boolean array of the pixels included in the partial frame
+        sums.
+    slab : tuple, optional
+        Index of the first frame and the frames of a slab that has
+        already been read, passed to `read_frames`, by default None
+
+    Returns
+    -------
+    int, tuple
+        Index of the first z-value and a tuple containing the sum of the
+        slab frames, the frame and partial frame sums of each frame, and
+        the minimum and maximum of each pixel over the slab
+    """
+    v = read_frames(data_file, data_path, j, k, slab=slab)
+    frames = v.reshape(len(v), -1)
+    total = frames.sum(1)
+
+    def weighted_sum(weights):
+        weights = np.ravel(weights)
+        if np.count_nonzero(weights) < weights.size // 2:
+            return frames[:, np.flatnonzero(weights)].sum(1)
+        else:
+            return total - frames[:, np.flatnonzero(~weights)].sum(1)
+
+    return i, (v.sum(0), weighted_sum(frame_weights),
+               weighted_sum(partial_weights), v.min(0), v.max(0))
+
+
+def merge_peaks(results, ends):
+    """Merge the peak tables of separate slabs.
+
+    Parameters
+    ----------
+    results : list of tuples
+        List of (i, peaks) values returned by the peak searches, where
+        i is the first output frame of each slab.
+    ends : dict
+        End of the output frames of each slab, with the values of i as
+        keys. Peaks outside the output frames are discarded.
+
+    Returns
+    -------
+    ndarray
+        Structured array of dtype `peak_dtype` containing the peaks in
+        frame order.
+    """
+    tables = [peaks[(peaks['z'] >= i) & (peaks['z'] < ends[i])]
+              for i, peaks in results]
+    if tables:
+        peaks = np.concatenate(tables)
+        return peaks[np.argsort(peaks['z'], kind='stable')]
+    else:
+        return peak_table()
+
+
+def peak_table(blobs=None):
+    """Return a structured array containing the parameters of each blob.
+
+    Parameters
+    ----------
+    blobs : list of NXBlobs, optional
+        Blobs to be stored in the table, by default None.
+
+    Returns
+    -------
+    ndarray
+        Structured array of dtype `peak_dtype` with one row per blob.
+    """
+    if not blobs:
+        return np.zeros(0, dtype=peak_dtype)
+    return np.array([(b.x, b.y, b.z, b.sigx, b.sigy, b.sigz,
+                      float(b.intensity), b.max_value) for b in blobs],
+                    dtype=peak_dtype)
+
+
+def peak_search(data_file, data_path, i, j, k, threshold, min_pixels=10,
+                pixel_mask=None, slab=None):
     """Identify peaks in the slab of raw data
 
     Parameters
@@ -28,43 +672,416 @@ def peak_search(data_file, data_path, i, j, k, threshold, min_pixels=10):
         Index of first z-value of processed slab
     k : int
         Index of last z-value of processed slab
-    threshold : float
-        Peak threshold
+    threshold : float or list of floats
+        Peak threshold. If a list of thresholds is given, the local
+        maxima are found once at the lowest threshold and then linked
+        separately for each threshold.
+    min_pixels : int, optional
+        Minimum number of pixels between peaks, by default 10
+    pixel_mask : array-like, optional
+        2D detector mask. Masked pixels, with values of 1, are set to
+        zero before the search, by default None
+    slab : tuple, optional
+        Index of the first frame and the frames of a slab that has
+        already been read, passed to `read_frames`, by default None
 
     Returns
     -------
-    list of NXBlobs
-        Peak locations and intensities stored in NXBlob instances
+    int, ndarray or list of ndarrays
+        Index of the first z-value and a structured array of dtype
+        `peak_dtype` containing the peak locations and intensities, or
+        a list of such arrays, one per threshold
     """
-    nxsetconfig(lock=3600, lockexpiry=28800)
+    data = masked_frames(data_file, data_path, j, k, pixel_mask, slab=slab)
+
+    thresholds = np.atleast_1d(threshold)
+    maxima = [peak_local_max(frame, min_distance=min_pixels,
+                             threshold_abs=thresholds.min())
+              for frame in data]
+    tables = []
+    for t in thresholds:
+        peaks = link_maxima(data, maxima, t, min_pixels=min_pixels)
+        peaks['z'] += j
+        tables.append(peaks)
+    if np.ndim(threshold) == 0:
+        return i, tables[0]
+    else:
+        return i, tables
+
+
+def link_maxima(data, maxima, threshold, min_pixels=10):
+    """Link the local maxima of each frame into a table of refined peaks.
 
-    with nxopen(data_file, "r") as data_root:
-        data = data_root[data_path][j:k].nxvalue.clip(0)
+    Parameters
+    ----------
+    data : ndarray
+        3D slab of raw data.
+    maxima : list of ndarrays
+        Coordinates of the local maxima in each frame, in the order
+        returned by `peak_local_max`. Maxima that do not exceed the
+        threshold are ignored.
+    threshold : float
+        Peak threshold.
+    min_pixels : int, optional
+        Minimum number of pixels between peaks, by default 10.
 
-    nframes = data.shape[0]
-    saved_blobs = []
+    Returns
+    -------
+    ndarray
+        Structured array of dtype `peak_dtype`, with z-values relative to
+        the start of the slab.
+    """
+    closed_blobs = []
     last_blobs = []
-    for z in range(nframes):
+    for z, coords in enumerate(maxima):
+        coords = coords[data[z, coords[:, 0], coords[:, 1]] > threshold]
         blobs = [
             NXBlob(x, y, z, data[z, int(y), int(x)], min_pixels=min_pixels)
-            for y, x in peak_local_max(
-                data[z], min_distance=min_pixels, threshold_abs=threshold
-            )
+            for y, x in coords
         ]
-        for lb in last_blobs:
-            found = False
-            for b in blobs:
-                if lb == b:
-                    found = True
-                    b.update(lb)
-            if not found:
-                lb.refine(data)
-                if lb.is_valid():
-                    saved_blobs.append(lb)
+        closed_blobs.extend(link_blobs(last_blobs, blobs))
         last_blobs = blobs
-    for blob in saved_blobs:
-        blob.z += j
-    return i, saved_blobs
+    peaks = refine_peaks(data, peak_table(closed_blobs), min_pixels)
+    return peaks[(peaks['sigx'] >= 0.5) & (peaks['sigy'] >= 0.5)]
+
+
+def refine_peaks(data, peaks, min_pixels=10, batch_size=256):
+    """Refine the positions, widths and intensities of a table of peaks.
+
+    The moments of each peak are calculated from a box of data of size
+    `2*min_pixels` centered on the peak maximum, clipped at the edges of
+    the slab. The boxes of each batch of peaks are gathered into a single
+    array, so the moments of all the peaks are calculated with a few
+    vectorized reductions.
+
+    Parameters
+    ----------
+    data : ndarray
+        3D slab of raw data.
+    peaks : ndarray
+        Structured array of dtype `peak_dtype`, whose x, y, and z values
+        define the peak maxima within the slab.
+    min_pixels : int, optional
+        Half-width of the box used to refine each peak, by default 10.
+    batch_size : int, optional
+        Number of peaks refined in each batch, by default 256.
+
+    Returns
+    -------
+    ndarray
+        The input peak table with refined values.
+    """
+    offsets = np.arange(-min_pixels, min_pixels)
+    for start in range(0, len(peaks), batch_size):
+        batch = peaks[start:start+batch_size]
+        idx, valid = [], []
+        for axis, name in enumerate(['z', 'y', 'x']):
+            i = batch[name].astype(int)[:, np.newaxis] + offsets
+            valid.append((i >= 0) & (i < data.shape[axis]))
+            idx.append(i)
+        slab = data[
+            np.clip(idx[0], 0, data.shape[0]-1)[:, :, None, None],
+            np.clip(idx[1], 0, data.shape[1]-1)[:, None, :, None],
+            np.clip(idx[2], 0, data.shape[2]-1)[:, None, None, :]
+            ].astype(np.float64)
+        slab *= (valid[0][:, :, None, None] & valid[1][:, None, :, None]
+                 & valid[2][:, None, None, :])
+        for axis, name in enumerate(['z', 'y', 'x']):
+            y = slab.sum(tuple(a for a in (1, 2, 3) if a != axis+1))
+            y /= y.sum(1)[:, np.newaxis]
+            c = (y * idx[axis]).sum(1)
+            batch[name] = c
+            batch['sig'+name] = np.sqrt(np.abs(
+                (y * (idx[axis] - c[:, np.newaxis])**2).sum(1)))
+        batch['intensity'] = slab.sum((1, 2, 3))
+    return peaks
+
+
+def label_search(data_file, data_path, i, j, k, threshold, min_pixels=10,
+                 pixel_mask=None, slab=None):
+    """Identify peaks as connected regions of the slab above the threshold
+
+    This is an alternative to `peak_search`. Instead of searching each
+    frame for local maxima and linking them along z, the whole slab is
+    thresholded once and labelled with `scipy.ndimage.label`, so that
+    each peak is a 3D connected component. The intensities, centroids
+    and widths are then calculated from all the pixels in each component
+    with a single set of vectorized reductions.
+
+    Parameters
+    ----------
+    data_file : str
+        File path to the raw data file
+    data_path : str
+        Internal path to the raw data
+    i : int
+        Index of first z-value of output peaks
+    j : int
+        Index of first z-value of processed slab
+    k : int
+        Index of last z-value of processed slab
+    threshold : float or list of floats
+        Peak threshold. If a list of thresholds is given, the slab is
+        read once and labelled separately for each threshold.
+    min_pixels : int, optional
+        Minimum number of pixels in each peak, by default 10
+    pixel_mask : array-like, optional
+        2D detector mask. Masked pixels, with values of 1, are set to
+        zero before the search, by default None
+    slab : tuple, optional
+        Index of the first frame and the frames of a slab that has
+        already been read, passed to `read_frames`, by default None
+
+    Returns
+    -------
+    int, ndarray or list of ndarrays
+        Index of the first z-value and a structured array of dtype
+        `peak_dtype` containing the peak locations and intensities, or
+        a list of such arrays, one per threshold
+    """
+    data = masked_frames(data_file, data_path, j, k, pixel_mask, slab=slab)
+
+    tables = []
+    for t in np.atleast_1d(threshold):
+        peaks = label_peaks(data, t, min_pixels=min_pixels)
+        peaks['z'] += j
+        tables.append(peaks)
+    if np.ndim(threshold) == 0:
+        return i, tables[0]
+    else:
+        return i, tables
+
+
+def label_peaks(data, threshold, min_pixels=10):
+    """Return a table of the connected regions above the threshold.
+
+    Parameters
+    ----------
+    data : ndarray
+        3D slab of raw data.
+    threshold : float
+        Peak threshold.
+    min_pixels : int, optional
+        Minimum number of pixels in each peak, by default 10.
+
+    Returns
+    -------
+    ndarray
+        Structured array of dtype `peak_dtype`, with z-values relative to
+        the start of the slab.
+    """
+    labels, nlabels = ndimage.label(data > threshold)
+    if nlabels == 0:
+        return peak_table()
+    pixels = np.nonzero(labels)
+    label = labels[pixels]
+    weights = data[pixels].astype(np.float64)
+    counts = np.bincount(label, minlength=nlabels+1)[1:]
+    intensity = np.bincount(label, weights, minlength=nlabels+1)[1:]
+
+    peaks = np.zeros(nlabels, dtype=peak_dtype)
+    peaks['intensity'] = intensity
+    peaks['max_value'] = ndimage.maximum(weights, label,
+                                         np.arange(1, nlabels+1))
+    for axis, name in enumerate(['z', 'y', 'x']):
+        c = np.bincount(label, weights * pixels[axis],
+                        minlength=nlabels+1)[1:] / intensity
+        peaks[name] = c
+        peaks['sig'+name] = np.sqrt(np.bincount(
+            label, weights * (pixels[axis] - c[label-1])**2,
+            minlength=nlabels+1)[1:] / intensity)
+    return peaks[(counts >= min_pixels) &
+                 (peaks['sigx'] >= 0.5) & (peaks['sigy'] >= 0.5)]
+
+
+def binned_maximum(data, bins):
+    """Return the maximum value within each bin of a 3D array.
+
+    Bins at the upper edges of the array contain the remaining values if
+    the array shape is not a multiple of the bin size.
+
+    Parameters
+    ----------
+    data : ndarray
+        3D array to be binned.
+    bins : tuple of ints
+        Size of the bins along each axis.
+
+    Returns
+    -------
+    ndarray
+        Array of the maximum value in each bin.
+    """
+    binned = data
+    for axis, size in enumerate(bins):
+        binned = np.moveaxis(binned, axis, 0)
+        maximum = binned[0::size].copy()
+        for offset in range(1, size):
+            values = binned[offset::size]
+            np.maximum(maximum[:len(values)], values,
+                       out=maximum[:len(values)])
+        binned = np.moveaxis(maximum, 0, axis)
+    return binned
+
+
+def binned_search(data_file, data_path, i, j, k, threshold, min_pixels=10,
+                  bins=(4, 4, 4), pixel_mask=None, slab=None):
+    """Identify peaks in regions selected from a binned copy of the slab
+
+    The slab is first reduced by taking the maximum value in each bin,
+    and the connected regions of bins above the threshold are labelled.
+    Only these regions are then searched at full resolution, using
+    `label_peaks`, so the peaks are the same as those found by
+    `label_search`, but most of the slab is only processed once. This
+    makes it a fast pre-search when the peaks are sparse.
+
+    Parameters
+    ----------
+    data_file : str
+        File path to the raw data file
+    data_path : str
+        Internal path to the raw data
+    i : int
+        Index of first z-value of output peaks
+    j : int
+        Index of first z-value of processed slab
+    k : int
+        Index of last z-value of processed slab
+    threshold : float or list of floats
+        Peak threshold. If a list of thresholds is given, the slab is
+        read and binned once and searched separately for each threshold.
+    min_pixels : int, optional
+        Minimum number of pixels in each peak, by default 10
+    bins : tuple of ints, optional
+        Size of the bins along z, y, and x, by default (4, 4, 4)
+    pixel_mask : array-like, optional
+        2D detector mask. Masked pixels, with values of 1, are set to
+        zero before the search, by default None
+    slab : tuple, optional
+        Index of the first frame and the frames of a slab that has
+        already been read, passed to `read_frames`, by default None
+
+    Returns
+    -------
+    int, ndarray or list of ndarrays
+        Index of the first z-value and a structured array of dtype
+        `peak_dtype` containing the peak locations and intensities, or
+        a list of such arrays, one per threshold
+    """
+    data = masked_frames(data_file, data_path, j, k, pixel_mask, slab=slab)
+
+    binned = binned_maximum(data, bins)
+
+    tables = []
+    for t in np.atleast_1d(threshold):
+        labels, _ = ndimage.label(binned > t)
+        regions = []
+        for n, region in enumerate(ndimage.find_objects(labels), 1):
+            box = tuple(slice(r.start*size, min(r.stop*size, length))
+                        for r, size, length in zip(region, bins, data.shape))
+            mask = labels[region] == n
+            for axis, size in enumerate(bins):
+                mask = mask.repeat(size, axis=axis)
+            mask = mask[tuple(slice(0, b.stop-b.start) for b in box)]
+            peaks = label_peaks(np.where(mask, data[box], 0), t,
+                                min_pixels=min_pixels)
+            for b, name in zip(box, ['z', 'y', 'x']):
+                peaks[name] += b.start
+            regions.append(peaks)
+        if regions:
+            peaks = np.concatenate(regions)
+        else:
+            peaks = peak_table()
+        peaks['z'] += j
+        tables.append(peaks)
+    if np.ndim(threshold) == 0:
+        return i, tables[0]
+    else:
+        return i, tables
+
+
+def link_blobs(last_blobs, blobs, radius=10.0):
+    """Merge the blobs in the current frame with those in the last frame.
+
+    Each blob in the current frame is updated by every blob in the last
+    frame that lies within the specified radius, in the order of the
+    last blobs, as defined by `NXBlob.__eq__` and `NXBlob.update`. The
+    candidate pairs are found with a single KD-tree query, so the cost
+    scales as O((n+m) log m) rather than O(n*m). Blobs whose matches
+    depend on the order of earlier updates are resolved sequentially.
+
+    Parameters
+    ----------
+    last_blobs : list of NXBlobs
+        Blobs found in the previous frame.
+    blobs : list of NXBlobs
+        Blobs found in the current frame. These are updated in place.
+    radius : float, optional
+        Maximum separation of linked blobs, by default 10.0.
+
+    Returns
+    -------
+    list of NXBlobs
+        Blobs in the last frame that were not linked to the current frame.
+    """
+    if not last_blobs:
+        return []
+    elif not blobs:
+        return list(last_blobs)
+
+    def positions(bs):
+        return np.array([(b.x, b.y, b.z) for b in bs], dtype=float)
+
+    def linked(p, q):
+        return ((p - q)**2).sum(-1) < radius**2
+
+    last_xyz, xyz = positions(last_blobs), positions(blobs)
+    tree = cKDTree(xyz)
+    pairs = [(m, n) for m, ns in enumerate(tree.query_ball_point(last_xyz,
+                                                                 radius))
+             for n in ns]
+    if not pairs:
+        return list(last_blobs)
+    m, n = np.array(pairs).T
+    keep = linked(last_xyz[m], xyz[n])
+    m, n = m[keep], n[keep]
+
+    # Blobs that move onto a last blob may then be linked to its neighbors
+    last_pairs = cKDTree(last_xyz).query_pairs(radius, output_type='ndarray')
+    last_pairs = last_pairs[linked(last_xyz[last_pairs[:, 0]],
+                                   last_xyz[last_pairs[:, 1]])]
+    counts = np.bincount(n, minlength=len(blobs))
+    if len(last_pairs) > 0:
+        _, group = connected_components(
+            coo_matrix((np.ones(len(last_pairs)), tuple(last_pairs.T)),
+                       shape=(len(last_blobs),) * 2), directed=False)
+        group_size = np.bincount(group)
+        clustered = group_size[group[m]] > 1
+    else:
+        group = None
+        clustered = np.zeros(len(m), dtype=bool)
+    complex_blobs = np.zeros(len(blobs), dtype=bool)
+    complex_blobs[n[clustered]] = True
+    complex_blobs[counts > 1] = True
+
+    found = np.zeros(len(last_blobs), dtype=bool)
+    for lm, bn in zip(m, n):
+        if not complex_blobs[bn]:
+            found[lm] = True
+            blobs[bn].update(last_blobs[lm])
+
+    for bn in np.where(complex_blobs)[0]:
+        b = blobs[bn]
+        candidates = m[n == bn]
+        if group is not None:
+            candidates = np.where(np.isin(group, group[candidates]))[0]
+        for lm in sorted(candidates):
+            lb = last_blobs[lm]
+            if linked(last_xyz[lm], np.array((b.x, b.y, b.z), dtype=float)):
+                found[lm] = True
+                b.update(lb)
+
+    return [lb for lb, f in zip(last_blobs, found) if not f]
 
 
 class NXBlob:
@@ -110,21 +1127,11 @@ class NXBlob:
             self.max_value = other.max_value
 
     def refine(self, data):
-        def peak_range():
-            idx = []
-            for i in range(3):
-                idx.append(np.s_[max(0, self.xyz[i] - self.min_pixels):
-                           min(self.xyz[i] + self.min_pixels, data.shape[i])])
-            return tuple(idx)
-
-        slab = NXdata(data)[peak_range()]
-        slabx = slab.sum((0, 1))
-        self.x, self.sigx = slabx.mean().nxvalue, slabx.std().nxvalue
-        slaby = slab.sum((0, 2))
-        self.y, self.sigy = slaby.mean().nxvalue, slaby.std().nxvalue
-        slabz = slab.sum((1, 2))
-        self.z, self.sigz = slabz.mean().nxvalue, slabz.std().nxvalue
-        self.intensity = slab.sum()
+        peak = refine_peaks(data, peak_table([self]), self.min_pixels)[0]
+        self.x, self.y, self.z = peak['x'], peak['y'], peak['z']
+        self.sigx, self.sigy, self.sigz = (peak['sigx'], peak['sigy'],
+                                           peak['sigz'])
+        self.intensity = peak['intensity']
 
     def is_valid(self):
         if self.sigx < 0.5 or self.sigy < 0.5:
@@ -133,6 +1140,91 @@ class NXBlob:
             return True
 
 
+class NXGapMap:
+    """Gaps in a 2D detector, defined by its pixel mask.
+
+    The gaps are the columns and rows of the detector that are masked
+    over their entire length, e.g., the gaps between detector chips.
+    For each pixel in a gap, the map stores the indices of the columns
+    or rows on either side of the gap, so that the gaps in a mask can
+    be filled with a single indexed assignment along each axis.
+
+    Parameters
+    ----------
+    pixel_mask : array-like
+        2D detector mask. Values of 1 represent masked pixels.
+
+    Attributes
+    ----------
+    columns : list of tuple
+        Start and stop indices of each gap between columns.
+    rows : list of tuple
+        Start and stop indices of each gap between rows.
+    """
+
+    def __init__(self, pixel_mask):
+        pixel_mask = np.asarray(pixel_mask)
+        self.shape = pixel_mask.shape
+        self.columns = self._intervals(
+            pixel_mask.sum(0) == pixel_mask.shape[0])
+        self.rows = self._intervals(pixel_mask.sum(1) == pixel_mask.shape[1])
+        self._columns = self._sources(self.columns, self.shape[1])
+        self._rows = self._sources(self.rows, self.shape[0])
+
+    def __repr__(self):
+        return (f"NXGapMap(shape={self.shape}, columns={len(self.columns)}, "
+                f"rows={len(self.rows)})")
+
+    @staticmethod
+    def _intervals(gaps):
+        edges = np.diff(np.concatenate(([0], gaps.astype(np.int8), [0])))
+        return list(zip(np.flatnonzero(edges == 1).tolist(),
+                        np.flatnonzero(edges == -1).tolist()))
+
+    @staticmethod
+    def _sources(intervals, size):
+        """Return the gap indices and the indices on either side."""
+        index, lower, upper = [], [], []
+        for start, stop in intervals:
+            if start == 0 and stop == size:
+                continue
+            before = start - 1 if start > 0 else stop
+            after = stop if stop < size else start - 1
+            index.append(np.arange(start, stop))
+            lower.append(np.full(stop - start, before))
+            upper.append(np.full(stop - start, after))
+        if index:
+            return (np.concatenate(index), np.concatenate(lower),
+                    np.concatenate(upper))
+        else:
+            return None
+
+    def fill(self, mask):
+        """Fill in the gaps of a mask in place.
+
+        Each gap is filled with the maximum of the mask values on either
+        side of it. The columns are filled before the rows.
+
+        Parameters
+        ----------
+        mask : ndarray
+            Mask whose last two dimensions match the detector shape.
+
+        Returns
+        -------
+        ndarray
+            The mask with the gaps filled in.
+        """
+        if self._columns is not None:
+            index, lower, upper = self._columns
+            mask[..., index] = np.maximum(mask[..., lower], mask[..., upper])
+        if self._rows is not None:
+            index, lower, upper = self._rows
+            mask[..., index, :] = np.maximum(mask[..., lower, :],
+                                             mask[..., upper, :])
+        return mask
+
+
 def fill_gaps(mask, mask_gaps):
     """Fill in gaps in the detector.
 
@@ -147,34 +1239,19 @@ def fill_gaps(mask, mask_gaps):
     ----------
     mask : array-like
         3D mask before gap-filling.
-    mask_gaps : array-like
+    mask_gaps : array-like or NXGapMap
         2D detector mask. This has to be the same shape as the last two
         dimensions of the 3D mask. Values of 1 represent masked pixels.
+        A precomputed NXGapMap may be given instead.
 
     Returns
     -------
     array-like
         3D mask with the gaps filled in.
     """
-
-    def consecutive(arr):
-        return np.split(arr, np.where(np.diff(arr) != 1)[0]+1)
-
-    mask = mask.astype(float)
-    for i in range(2):
-        gaps = consecutive(np.where(mask_gaps.sum(i) == mask_gaps.shape[i])[0])
-        for gap in gaps:
-            if i == 0:
-                mask[:, :, gap[0]:gap[-1]+1] = np.tile(np.expand_dims(
-                    np.maximum(mask[:, :, gap[0]-1],
-                               mask[:, :, gap[-1]+1]), 2),
-                    (1, 1, len(gap)))
-            else:
-                mask[:, gap[0]:gap[-1]+1, :] = np.tile(np.expand_dims(
-                    np.maximum(mask[:, gap[0]-1, :],
-                               mask[:, gap[-1]+1, :]), 1),
-                    (1, len(gap), 1))
-    return mask
+    if not isinstance(mask_gaps, NXGapMap):
+        mask_gaps = NXGapMap(mask_gaps)
+    return mask_gaps.fill(mask.astype(float))
 
 
 def local_sum(X, K):
@@ -221,10 +1298,14 @@ def local_sum_same(X, K, padding):
     return G
 
 
-def mask_volume(data_file, data_path, mask_file, mask_path, i, j, k,
-                pixel_mask, threshold_1=2, horiz_size_1=11,
-                threshold_2=0.8, horiz_size_2=51):
-    """Generate a 3D mask around Bragg peaks.
+def mask_slab(data_file, data_path, i, j, k, gap_map, threshold_1=2,
+              horiz_size_1=11, threshold_2=0.8, horiz_size_2=51,
+              slab=None):
+    """Generate a 3D mask around Bragg peaks and return it bit-packed.
+
+    The mask of frames j+1 to k-1 is calculated by `calculate_mask` and
+    returned packed with `np.packbits`, so that it can be written to the
+    mask file by a single process.
 
     Parameters
     ----------
@@ -232,77 +1313,386 @@ def mask_volume(data_file, data_path, mask_file, mask_path, i, j, k,
         File path to the raw data file
     data_path : str
         Internal path to the raw data
-    mask_file : str
-        File path to the mask file
-    mask_path : str
-        Internal path to the mask array
     i : int
         Index of first z-value of output mask
     j : int
         Index of first z-value of processed slab
     k : int
         Index of last z-value of processed slab
-    pixel_mask : array-like
-        2D detector mask. This has to be the same shape as the last two
-        dimensions of the 3D slab. Values of 1 represent masked pixels.
-    horiz_size_1 : int, optional
-        Size of smaller convolution rectangles, by default 11
+    gap_map : NXGapMap
+        Gaps in the detector, defined by the detector pixel mask.
     threshold_1 : int, optional
         Threshold for performing the smaller convolution, by default 2
-    horiz_size_2 : int, optional
-        Size of larger convolution rectangles, by default 51
+    horiz_size_1 : int, optional
+        Size of smaller convolution rectangles, by default 11
     threshold_2 : float, optional
         Threshold for performing the larger convolution, by default 0.8
-    queue : Queue, optional
-        Queue used in multiprocessing, by default None
+    horiz_size_2 : int, optional
+        Size of larger convolution rectangles, by default 51
+    slab : tuple, optional
+        Index of the first frame and the frames of a slab that has
+        already been read, passed to `read_frames`, by default None
+
+    Returns
+    -------
+    int, ndarray
+        Index of first z-value of output mask and the packed mask
     """
+    volume = read_frames(data_file, data_path, j, k, slab=slab)
+    mask = calculate_mask(volume, gap_map, threshold_1, horiz_size_1,
+                          threshold_2, horiz_size_2)
+    return i, np.packbits(mask)
 
-    nxsetconfig(lock=3600, lockexpiry=28800)
-    with nxopen(data_file, 'r') as data_root:
-        volume = data_root[data_path][j:k].nxvalue
 
+def calculate_mask(volume, gap_map, threshold_1=2, horiz_size_1=11,
+                   threshold_2=0.8, horiz_size_2=51):
+    """Return the 3D mask around Bragg peaks in a slab of raw data.
+
+    The mask is calculated from the differences between neighboring
+    frames, so it is defined for all but the first and last frames of
+    the slab.
+
+    Parameters
+    ----------
+    volume : ndarray
+        3D slab of raw data.
+    gap_map : NXGapMap
+        Gaps in the detector, defined by the detector pixel mask.
+    threshold_1 : int, optional
+        Threshold for performing the smaller convolution, by default 2
+    horiz_size_1 : int, optional
+        Size of smaller convolution rectangles, by default 11
+    threshold_2 : float, optional
+        Threshold for performing the larger convolution, by default 0.8
+    horiz_size_2 : int, optional
+        Size of larger convolution rectangles, by default 51
+
+    Returns
+    -------
+    ndarray
+        Mask of the inner frames of the slab, with values of 1 for
+        masked pixels.
+    """
     horiz_size_1, horiz_size_2 = int(horiz_size_1), int(horiz_size_2)
     sum1, sum2 = horiz_size_1**2, horiz_size_2**2
-    horiz_kern_1 = np.ones((1, horiz_size_1, horiz_size_1))
-    horiz_kern_2 = np.ones((1, horiz_size_2, horiz_size_2))
-
-    diff_volume = volume[1:] - volume[:-1]
-
-    padded_length = [0, horiz_size_1, horiz_size_1]
-    vol_smoothed = local_sum_same(
-        np.pad(
-            diff_volume,
-            pad_width=((0, 0),
-                       (horiz_size_1, horiz_size_1),
-                       (horiz_size_1, horiz_size_1)),
-            mode='edge'),
-        horiz_kern_1, padded_length)
-    vol_smoothed /= sum1
-
-    vol_smoothed[np.abs(vol_smoothed) < threshold_1] = 0
-
-    vol_smoothed[vol_smoothed < 0] = 1
-    vol_smoothed[vol_smoothed > 0] = 1
-
-    vol_smoothed = fill_gaps(vol_smoothed, pixel_mask)
-
-    padded_length = [0, horiz_size_2, horiz_size_2]
-    vol_smoothed = local_sum_same(
-        np.pad(
-            vol_smoothed,
-            pad_width=((0, 0),
-                       (horiz_size_2, horiz_size_2),
-                       (horiz_size_2, horiz_size_2)),
-            mode='edge'),
-        horiz_kern_2, padded_length)
-    vol_smoothed /= sum2
-    vol_smoothed[vol_smoothed < threshold_2] = 0
-    vol_smoothed[vol_smoothed > threshold_2] = 1
-    nxsetconfig(lock=3600, lockexpiry=28800)
-    with nxopen(mask_file, 'rw') as mask_root:
-        mask_root[mask_path][j+1:k-1] = (
-            np.maximum(vol_smoothed[0:-1], vol_smoothed[1:]))
-    return i
+
+    mask = np.zeros((volume.shape[0]-2,) + volume.shape[1:], dtype=np.int8)
+    last_frame = None
+    for z in range(volume.shape[0]-1):
+        frame = box_sum(volume[z+1] - volume[z], horiz_size_1) / sum1
+        frame[np.abs(frame) < threshold_1] = 0
+        frame[frame < 0] = 1
+        frame[frame > 0] = 1
+        frame = gap_map.fill(frame)
+        frame = box_sum(frame.astype(np.int8), horiz_size_2) / sum2
+        frame[frame < threshold_2] = 0
+        frame[frame > threshold_2] = 1
+        if last_frame is not None:
+            mask[z-1] = np.maximum(last_frame, frame)
+        last_frame = frame
+    return mask
+
+
+class NXMaskWriter:
+    """Write slabs of a 3D mask to a NeXus field in frame order.
+
+    The slabs may be added in any order. They are held until all the
+    preceding frames have been added, and are then written in blocks
+    that start and end on chunk boundaries, so that each compressed
+    chunk is only written once.
+
+    Parameters
+    ----------
+    field : NXfield
+        3D mask field in a file opened with write access.
+    start : int
+        Index of the first frame to be written.
+    """
+
+    def __init__(self, field, start):
+        self.field = field
+        self.start = start
+        if field.chunks:
+            self.chunk_size = field.chunks[0]
+        else:
+            self.chunk_size = 1
+        self.slabs = {}
+
+    def __repr__(self):
+        return f"NXMaskWriter('{self.field.nxpath}', start={self.start})"
+
+    def add(self, start, mask):
+        """Add a slab of the mask, writing any completed chunks.
+
+        Parameters
+        ----------
+        start : int
+            Index of the first frame of the slab.
+        mask : ndarray
+            Mask of the slab.
+        """
+        self.slabs[start] = mask
+        self.write(final=False)
+
+    def add_packed(self, start, stop, packed):
+        """Add a slab of the mask packed by `np.packbits`.
+
+        Parameters
+        ----------
+        start : int
+            Index of the first frame of the slab.
+        stop : int
+            Index of the frame following the slab.
+        packed : ndarray
+            Packed mask of the slab, returned by `mask_slab`.
+        """
+        shape = (stop-start,) + tuple(self.field.shape[1:])
+        mask = np.unpackbits(packed, count=int(np.prod(shape)))
+        self.add(start, mask.reshape(shape).view(np.int8))
+
+    def write(self, final=True):
+        """Write the frames that follow the frames already written.
+
+        Parameters
+        ----------
+        final : bool, optional
+            Write all the remaining frames, even if they do not end on a
+            chunk boundary, by default True
+        """
+        slabs = []
+        stop = self.start
+        while stop in self.slabs:
+            slabs.append(self.slabs.pop(stop))
+            stop += len(slabs[-1])
+        if not slabs:
+            return
+        mask = np.concatenate(slabs)
+        if not final:
+            stop = max((stop // self.chunk_size) * self.chunk_size,
+                       self.start)
+            if stop < self.start + len(mask):
+                self.slabs[stop] = mask[stop-self.start:]
+                mask = mask[:stop-self.start]
+        if len(mask) > 0:
+            with self.field.nxfile:
+                self.field[self.start:stop] = mask
+            self.start = stop
+
+
+def box_sum(frame, size):
+    """Return the sum of the values in a square box around each pixel.
+
+    This is equivalent to `local_sum_same` applied to a frame padded with
+    `np.pad(mode='edge')`, but the sums are calculated from summed-area
+    tables along each axis, with the contributions of the pixels beyond
+    the edges added explicitly, so the frame is never padded. Integer
+    frames are summed as 64-bit integers, so the sums are exact.
+
+    Parameters
+    ----------
+    frame : ndarray
+        2D array of values.
+    size : int
+        Width of the box.
+
+    Returns
+    -------
+    ndarray
+        Array of box sums with the same shape as the frame.
+    """
+    after = (size - 1) // 2
+    before = size - 1 - after
+    if np.issubdtype(frame.dtype, np.integer):
+        dtype = np.int64
+    else:
+        dtype = np.float64
+    sums = frame
+    for axis in range(2):
+        values = np.moveaxis(sums, axis, 0)
+        n = values.shape[0]
+        table = np.zeros((n+1,) + values.shape[1:], dtype=dtype)
+        np.cumsum(values, axis=0, dtype=dtype, out=table[1:])
+        index = np.arange(n)
+        sums = (table[np.minimum(index+after, n-1)+1]
+                - table[np.maximum(index-before, 0)])
+        below = np.maximum(before-index, 0)
+        above = np.maximum(index+after-(n-1), 0)
+        sums += below[:, np.newaxis] * values[0].astype(dtype)
+        sums += above[:, np.newaxis] * values[-1].astype(dtype)
+        sums = np.moveaxis(sums, 0, axis)
+    return sums
+
+
+class NXCalibration:
+    """Azimuthal integrator and detector arrays of a powder calibration.
+
+    The pyFAI integrator is only created when it is first needed. Since
+    it caches the pixel coordinates and solid angles that it calculates,
+    the same instance is shared by all the entries with the same
+    calibration, using `get_calibration`. The polarization corrections
+    are also cached, both in memory and, optionally, in a NeXus file, so
+    that they can be reused by other processes.
+
+    Parameters
+    ----------
+    parameters : dict
+        PONI parameters of the calibration, with the names used in the
+        'refinement/parameters' group of the calibration, e.g.,
+        'Distance', 'Poni1', and 'Wavelength'.
+    shape : tuple of ints, optional
+        Shape of the detector, by default None, in which case the shape
+        is defined by the pyFAI detector.
+    cache_file : str, optional
+        File path to a NeXus file used to store the polarization
+        corrections, by default None
+    logger : logging.Logger, optional
+        Logger used to report cache errors, by default None, in which
+        case the module logger is used.
+    """
+
+    keywords = {'Distance': 'dist', 'Detector': 'detector', 'Poni1': 'poni1',
+                'Poni2': 'poni2', 'Rot1': 'rot1', 'Rot2': 'rot2',
+                'Rot3': 'rot3', 'PixelSize1': 'pixel1',
+                'PixelSize2': 'pixel2', 'Wavelength': 'wavelength'}
+
+    def __init__(self, parameters, shape=None, cache_file=None,
+                 logger=None):
+        self.parameters = {name: parameters[name] for name in self.keywords
+                           if name in parameters}
+        if shape is not None:
+            shape = tuple(int(n) for n in shape)
+        self.shape = shape
+        self.cache_file = cache_file
+        self.logger = logger or logging.getLogger(__name__)
+        self.key = self.calibration_key(self.parameters, self.shape)
+        self._integrator = None
+        self._polarization = {}
+
+    def __repr__(self):
+        return f"NXCalibration(key='{self.key}', shape={self.shape})"
+
+    @staticmethod
+    def calibration_key(parameters, shape=None):
+        """Return a string identifying the calibration and detector."""
+        text = repr((sorted(parameters.items()), shape))
+        return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+    @property
+    def integrator(self):
+        """The pyFAI azimuthal integrator defined by the calibration."""
+        if self._integrator is None:
+            from pyFAI.azimuthalIntegrator import AzimuthalIntegrator
+            self._integrator = AzimuthalIntegrator(
+                **{self.keywords[name]: value
+                   for name, value in self.parameters.items()})
+        return self._integrator
+
+    def polarization(self, factor):
+        """Return the polarization correction of each detector pixel.
+
+        Parameters
+        ----------
+        factor : float
+            Polarization factor of the beam.
+
+        Returns
+        -------
+        ndarray
+            2D array of the polarization corrections. The array is
+            shared by all callers, so it is read-only.
+        """
+        factor = float(factor)
+        if factor not in self._polarization:
+            name = f"calibration_{self.key}/polarization_{factor:.6f}"
+            name = name.replace('.', '_')
+            polarization = self._read_cache(name)
+            if polarization is None:
+                polarization = self.integrator.polarization(shape=self.shape,
+                                                            factor=factor)
+                self._write_cache(name, polarization)
+            polarization = np.array(polarization)
+            polarization.flags.writeable = False
+            self._polarization[factor] = polarization
+        return self._polarization[factor]
+
+    def _read_cache(self, name):
+        if self.cache_file is None or not os.path.exists(self.cache_file):
+            return None
+        try:
+            with nxopen(self.cache_file, 'r') as root:
+                if name in root:
+                    return root[name].nxvalue
+        except Exception as error:
+            self.logger.info(
+                f"Unable to read polarization from '{self.cache_file}': "
+                f"{error}")
+        return None
+
+    def _write_cache(self, name, value):
+        if self.cache_file is None:
+            return
+        try:
+            with nxopen(self.cache_file, 'a') as root:
+                group = name.split('/')[0]
+                if group not in root:
+                    root[group] = NXcollection()
+                if name not in root:
+                    root[name] = value
+        except Exception as error:
+            self.logger.info(
+                f"Unable to write polarization to '{self.cache_file}': "
+                f"{error}")
+
+
+def get_calibration(parameters, shape=None, detector=True, cache_file=None,
+                    logger=None):
+    """Return the shared calibration defined by the PONI parameters.
+
+    Parameters
+    ----------
+    parameters : NXparameters or dict
+        Refined parameters of a powder calibration, e.g., stored in
+        'instrument/calibration/refinement/parameters'.
+    shape : tuple of ints, optional
+        Shape of the detector, by default None
+    detector : bool, optional
+        Define the integrator with the named pyFAI detector, instead of
+        the pixel sizes alone, by default True
+    cache_file : str, optional
+        File path to a NeXus file used to store the polarization
+        corrections, by default None
+    logger : logging.Logger, optional
+        Logger used to report cache errors, by default None
+
+    Returns
+    -------
+    NXCalibration
+        Calibration shared by all calls with the same parameters and
+        detector shape.
+    """
+    values = {}
+    for name in NXCalibration.keywords:
+        if name == 'Detector' and not detector:
+            continue
+        if name in parameters:
+            value = parameters[name]
+            if isinstance(value, NXfield):
+                value = value.nxvalue
+            values[name] = (str(value) if name == 'Detector'
+                            else float(value))
+    if shape is not None:
+        shape = tuple(int(n) for n in shape)
+    key = NXCalibration.calibration_key(values, shape)
+    if key not in _calibrations:
+        _calibrations[key] = NXCalibration(values, shape=shape,
+                                           cache_file=cache_file,
+                                           logger=logger)
+    else:
+        if cache_file is not None:
+            _calibrations[key].cache_file = cache_file
+        if logger is not None:
+            _calibrations[key].logger = logger
+    return _calibrations[key]
 
 
 def init_julia():
@@ -594,11 +1984,22 @@ class SpecParser:
 
 
 class NXExecutor(ProcessPoolExecutor):
-    """ProcessPoolExecutor class using 'spawn' for new processes."""
+    """ProcessPoolExecutor class using 'spawn' for new processes.
+
+    An optional initializer, such as `init_worker`, is called with
+    `initargs` when each worker process starts.
+
+    Attributes
+    ----------
+    max_workers : int
+        Maximum number of worker processes.
+    """
 
-    def __init__(self, max_workers=None):
+    def __init__(self, max_workers=None, initializer=None, initargs=()):
         mp_context = get_context('spawn')
-        super().__init__(max_workers=max_workers, mp_context=mp_context)
+        super().__init__(max_workers=max_workers, mp_context=mp_context,
+                         initializer=initializer, initargs=initargs)
+        self.max_workers = self._max_workers
 
     def __repr__(self):
-        return f"NXExecutor(max_workers={self._max_workers})"
+        return f"NXExecutor(max_workers={self.max_workers})"
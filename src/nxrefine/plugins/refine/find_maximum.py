@@ -52,8 +52,8 @@ class MaximumDialog(NXDialog):
             self.parameters.add('last', '', 'Last Frame')
             self.parameters.add('qmin', '', 'Minimum Scattering Q (Ang-1)')
             self.parameters.add('qmax', '', 'Maximum Scattering Q (Ang-1)')
-            self.parameters.add('fw', '5', 'Frame Window')
-            self.parameters.add('fs', '20', 'Filter Size')
+            self.parameters.add('fw', '5', 'Frame Window(s)')
+            self.parameters.add('fs', '20', 'Filter Size(s)')
             self.insert_layout(1, self.parameters.grid())
             self.insert_layout(
                 2, self.make_layout(self.action_buttons(('Find Maximum',
@@ -70,7 +70,8 @@ class MaximumDialog(NXDialog):
             self.insert_layout(
                 4, self.make_layout(self.action_buttons(
                     ('Plot Transmission Mask', self.plot_transmission_mask),
-                    ('Plot Transmission', self.plot_transmission))))
+                    ('Plot Transmission', self.plot_transmission),
+                    ('Compare Transmissions', self.compare_transmissions))))
             self.checkbox['copy'] = NXCheckBox('Copy to other entries?')
             self.insert_layout(
                 5, self.make_layout(self.action_buttons(
@@ -138,17 +139,33 @@ class MaximumDialog(NXDialog):
         except Exception:
             return None
 
+    @property
+    def frame_windows(self):
+        try:
+            values = str(self.parameters['fw'].value).split(',')
+            return [int(v) for v in values]
+        except Exception:
+            return None
+
+    @property
+    def filter_sizes(self):
+        try:
+            values = str(self.parameters['fs'].value).split(',')
+            return [int(v) for v in values]
+        except Exception:
+            return None
+
     @property
     def frame_window(self):
         try:
-            return int(self.parameters['fw'].value)
+            return self.frame_windows[0]
         except Exception:
             return None
 
     @property
     def filter_size(self):
         try:
-            return int(self.parameters['fs'].value)
+            return self.filter_sizes[0]
         except Exception:
             return None
 
@@ -259,10 +276,11 @@ class MaximumDialog(NXDialog):
         self.pv.aspect = 'equal'
         self.pv.ytab.flipped = True
 
-    def calculate_transmission(self):
+    def calculate_transmission(self, settings=None):
         self.reduce.partial_frames = self.partial_frames
         return self.reduce.calculate_transmission(
-            frame_window=self.frame_window, filter_size=self.filter_size)
+            frame_window=self.frame_window, filter_size=self.filter_size,
+            settings=settings)
 
     def plot_transmission(self):
         if self.partial_frames:
@@ -278,6 +296,29 @@ class MaximumDialog(NXDialog):
         else:
             display_message('Partial frames not available')
 
+    def compare_transmissions(self):
+        if self.partial_frames:
+            if self.frame_windows is None or self.filter_sizes is None:
+                display_message('Invalid frame windows or filter sizes')
+                return
+            self.reduce.qmin = self.qmin
+            self.reduce.qmax = self.qmax
+            settings = [(dx, ms) for dx in self.frame_windows
+                        for ms in self.filter_sizes]
+            transmissions = self.calculate_transmission(settings=settings)
+            for i, (dx, ms) in enumerate(settings):
+                transmission = transmissions[(dx, ms)]
+                if 'maximum' in transmission.nxsignal.attrs:
+                    transmission *= transmission.nxsignal.attrs['maximum']
+                transmission.title = (
+                    f'Frame Window {dx}, Filter Size {ms}')
+                if i == 0 and not self.over:
+                    self.pv.plot(transmission, markersize=2)
+                else:
+                    transmission.oplot(markersize=2)
+        else:
+            display_message('Partial frames not available')
+
     def save_transmission(self):
         if self.partial_frames:
             transmission = self.calculate_transmission()
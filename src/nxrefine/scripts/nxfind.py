@@ -21,12 +21,19 @@ def main():
     parser.add_argument('-e', '--entries', nargs='+',
                         help='names of entries to be searched')
     parser.add_argument('-t', '--threshold', type=float, help='peak threshold')
+    parser.add_argument('-s', '--sweep', type=float, nargs='+',
+                        help='list peak numbers for these thresholds')
     parser.add_argument('-f', '--first', type=int, help='first frame')
     parser.add_argument('-l', '--last', type=int, help='last frame')
     parser.add_argument('-P', '--pixels', type=int,
                         help='minimum pixels between peaks')
+    parser.add_argument('-E', '--engine',
+                        choices=['maxima', 'label', 'binned'],
+                        help='peak search engine')
     parser.add_argument('-o', '--overwrite', action='store_true',
                         help='overwrite existing peaks')
+    parser.add_argument('-L', '--live', action='store_true',
+                        help='search while the raw data are being written')
     parser.add_argument('-p', '--parent', default=None,
                         help='The parent .nxs file to use')
     parser.add_argument('-m', '--monitor', action='store_true',
@@ -45,10 +52,15 @@ def main():
         reduce = NXReduce(entry, args.directory, find=True,
                           threshold=args.threshold,
                           first=args.first, last=args.last,
-                          min_pixels=args.pixels,
-                          overwrite=args.overwrite,
+                          min_pixels=args.pixels, engine=args.engine,
+                          overwrite=args.overwrite, live=args.live,
                           monitor_progress=args.monitor)
-        if args.queue:
+        if args.sweep:
+            peaks = reduce.find_peaks(thresholds=args.sweep)
+            print(f"{entry}\n{'Threshold':>12} {'Peaks':>8}")
+            for threshold in peaks:
+                print(f"{threshold:12g} {len(peaks[threshold]):8d}")
+        elif args.queue:
             reduce.queue('nxfind', args)
         else:
             reduce.nxfind()
@@ -46,6 +46,8 @@ def main():
                         help='perform CCTW transforms with 3D mask')
     parser.add_argument('-o', '--overwrite', action='store_true',
                         help='overwrite existing maximum')
+    parser.add_argument('-F', '--fused', action='store_true',
+                        help='read raw data once for max, find and prepare')
     parser.add_argument('-q', '--queue', action='store_true',
                         help='add to server task queue')
 
@@ -63,7 +65,7 @@ def main():
                           prepare=args.prepare, transform=args.transform,
                           combine=args.combine, pdf=args.pdf,
                           regular=args.regular, mask=args.mask,
-                          overwrite=args.overwrite)
+                          overwrite=args.overwrite, fused=args.fused)
         if args.queue:
             reduce.queue('nxreduce', args)
         else: